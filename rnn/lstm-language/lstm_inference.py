@@ -1,6 +1,8 @@
 import sys
+from collections import OrderedDict
 
 import mxnet as mx
+import numpy as np
 
 sys.path.append("..")
 from rnn_unroll import rnn_unroll
@@ -76,44 +78,149 @@ def lstm_inference_symbol(num_lstm_layer, input_size,
         output.append(state.h)
     return mx.sym.Group(output)
 
+class PrefixEntry(object):
+    """The next word distribution (1, num_label) and the states (1, num_hidden) after a prefix"""
+    def __init__(self, prob, states):
+        self.prob = prob
+        self.states = states
+
+class PrefixCache(object):
+    """Trie of the word id prefixes, with the PrefixEntry of the cached ones, LRU evicted
+
+    lookup returns the longest cached prefix of a prompt. The counters give the hit rate
+    (prompts with a cached prefix) and the words saved (the cached prefix lengths).
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.root = {'children' : {}, 'entry' : None}
+        self.lru = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.tokens = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+
+    def lookup(self, prompt):
+        """Outputs: (length, entry) of the longest cached prefix of prompt, (0, None) if none"""
+        node = self.root
+        length, entry = 0, None
+        for i, word in enumerate(prompt):
+            node = node['children'].get(word)
+            if node is None:
+                break
+            if node['entry'] is not None:
+                length, entry = i + 1, node['entry']
+        if entry is not None:
+            key = tuple(prompt[:length])
+            self.lru[key] = self.lru.pop(key)
+        self.lookups += 1
+        self.tokens += len(prompt)
+        if entry is not None:
+            self.hits += 1
+            self.tokens_saved += length
+        return length, entry
+
+    def insert(self, prompt, entry):
+        node = self.root
+        for word in prompt:
+            node = node['children'].setdefault(word, {'children' : {}, 'entry' : None})
+        node['entry'] = entry
+        key = tuple(prompt)
+        self.lru.pop(key, None)
+        self.lru[key] = True
+        while len(self.lru) > self.max_entries:
+            self.evict(self.lru.popitem(last = False)[0])
+
+    def evict(self, key):
+        path = [self.root]
+        for word in key:
+            path.append(path[-1]['children'][word])
+        path[-1]['entry'] = None
+        # remove the nodes left without entry and children
+        for i in xrange(len(key), 0, -1):
+            node = path[i]
+            if node['entry'] is not None or len(node['children']) > 0:
+                break
+            del path[i - 1]['children'][key[i - 1]]
+        self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries' : len(self.lru),
+            'lookups' : self.lookups,
+            'hits' : self.hits,
+            'hit_rate' : self.hits / float(max(self.lookups, 1)),
+            'tokens' : self.tokens,
+            'tokens_saved' : self.tokens_saved,
+            'evictions' : self.evictions
+        }
+
 class LSTMInferenceModel(object):
+    """LSTM language model inference
+
+    forward: one token of one sentence (batch_size 1, seq_len 1).
+    prefill: the whole prompts of a batch in one forward of the graph unrolled at their length.
+    generate: prefill, then the tokens of all the prompts are sampled together, the
+        top-k / temperature sampling is done on ctx and only the generated ids are copied back.
+    The executors are bound once per (seq_len, batch_size) and share the parameters.
+    With cache_size > 0, the states after the prompts are kept in a PrefixCache of
+    cache_size entries, a prompt extending a cached one only runs the new words.
+    """
     def __init__(self, num_lstm_layer, input_size,
             num_hidden, num_embed, num_label,
-            arg_params, ctx=mx.cpu(), dropout=0.):
-        self.sym = rnn_unroll(
-            num_layers = num_lstm_layer,
-            seq_len = 1,
-            input_size = input_size,
-            num_hidden = num_hidden,
-            num_embed = num_embed,
-            num_label = num_label,
+            arg_params, ctx=mx.cpu(), dropout=0., cache_size=0):
+        self.num_lstm_layer = num_lstm_layer
+        self.input_size = input_size
+        self.num_hidden = num_hidden
+        self.num_embed = num_embed
+        self.num_label = num_label
+        self.ctx = ctx
+        self.arg_params = dict((key, value.as_in_context(ctx)) for key, value in arg_params.items())
+        self.executors = {}
+        self.prefix_cache = PrefixCache(cache_size) if cache_size > 0 else None
+
+        self.state_name = []
+        for i in range(num_lstm_layer):
+            self.state_name.append("ptb_l%d_init_h" % i)
+            self.state_name.append("ptb_l%d_init_c" % i)
+
+        self.executor = self.bind(1, 1)
+        self.states_dict = dict(zip(self.state_name, self.executor.outputs[1:]))
+        self.input_arr = mx.nd.zeros((1, 1))
+
+    def get_executor(self, seq_len, batch_size):
+        """The cached executor of seq_len and batch_size, used by prefill and generate"""
+        key = (seq_len, batch_size)
+        if key not in self.executors:
+            self.executors[key] = self.bind(seq_len, batch_size)
+        return self.executors[key]
+
+    def bind(self, seq_len, batch_size):
+        """The inference graph unrolled at seq_len for batch_size sentences"""
+        sym = rnn_unroll(
+            num_layers = self.num_lstm_layer,
+            seq_len = seq_len,
+            input_size = self.input_size,
+            num_hidden = self.num_hidden,
+            num_embed = self.num_embed,
+            num_label = self.num_label,
             ignore_label = -1,
             mode = 'lstm', 
             bi_directional = False,
             dropout = 0., 
             train = False
         )
-        batch_size = 1
-        init_c = [('ptb_l%d_init_c'%l, (batch_size, num_hidden)) for l in range(num_lstm_layer)]
-        init_h = [('ptb_l%d_init_h'%l, (batch_size, num_hidden)) for l in range(num_lstm_layer)]
-        
-        data_shape = [("data", (batch_size, 1)), ("mask", (batch_size, 1))]
-
-        input_shapes = dict(init_c + init_h + data_shape)
-        self.executor = self.sym.simple_bind(ctx=mx.cpu(), **input_shapes)
-
-        for key in self.executor.arg_dict.keys():
-            if key in arg_params:
-                #print key, arg_params[key].shape, self.executor.arg_dict[key].shape
-                arg_params[key].copyto(self.executor.arg_dict[key])
-   
-        state_name = []
-        for i in range(num_lstm_layer):
-            state_name.append("ptb_l%d_init_h" % i)
-            state_name.append("ptb_l%d_init_c" % i)
-
-        self.states_dict = dict(zip(state_name, self.executor.outputs[1:]))
-        self.input_arr = mx.nd.zeros(data_shape[0][1])
+        input_shapes = dict([(name, (batch_size, self.num_hidden)) for name in self.state_name] + 
+            [("data", (batch_size, seq_len)), ("mask", (batch_size, seq_len))])
+        arg_shapes, _, aux_shapes = sym.infer_shape(**input_shapes)
+        args = {}
+        for name, shape in zip(sym.list_arguments(), arg_shapes):
+            if name in self.arg_params:
+                args[name] = self.arg_params[name]
+            else:
+                args[name] = mx.nd.zeros(shape, self.ctx)
+        aux_states = [mx.nd.zeros(shape, self.ctx) for shape in aux_shapes]
+        return sym.bind(ctx = self.ctx, args = args, grad_req = 'null', aux_states = aux_states)
 
     def forward(self, input_data, input_mask):
         input_data.copyto(self.executor.arg_dict["data"])
@@ -123,3 +230,122 @@ class LSTMInferenceModel(object):
             self.states_dict[key].copyto(self.executor.arg_dict[key])
         prob = self.executor.outputs[0].asnumpy()
         return prob
+
+    def run_prompts(self, prompts, begin_states = None):
+        """Run the prompts (lists of word ids, not empty) through the unrolled graph in one forward
+
+        The prompts are right padded, the mask keeps the states unchanged on the pads,
+        so the last states are the ones after the last word of every prompt.
+            Inputs:
+                begin_states: None (zero states) or, for every prompt, None or the list of
+                    NDArray (1, num_hidden) states it starts from, in the order of state_name
+            Outputs:
+                prob: NDArray (batch_size, num_label), the next word distribution of every prompt
+                states: list of NDArray (batch_size, num_hidden), in the order of state_name
+        """
+        batch_size = len(prompts)
+        seq_len = max([len(prompt) for prompt in prompts])
+        data = np.zeros((batch_size, seq_len))
+        mask = np.zeros((batch_size, seq_len))
+        for i, prompt in enumerate(prompts):
+            data[i, :len(prompt)] = prompt
+            mask[i, :len(prompt)] = 1
+        executor = self.get_executor(seq_len, batch_size)
+        executor.arg_dict["data"][:] = data
+        executor.arg_dict["mask"][:] = mask
+        for name in self.state_name:
+            executor.arg_dict[name][:] = 0
+        if begin_states is not None:
+            for i, states in enumerate(begin_states):
+                if states is None:
+                    continue
+                for name, state in zip(self.state_name, states):
+                    state.copyto(executor.arg_dict[name][i:i+1])
+        executor.forward()
+        # the softmax rows are time major: row t * batch_size + i is word t of prompt i
+        last = np.array([(len(prompt) - 1) * batch_size + i for i, prompt in enumerate(prompts)])
+        prob = mx.nd.take(executor.outputs[0], mx.nd.array(last, self.ctx))
+        return prob, executor.outputs[1:]
+
+    def prefill(self, prompts):
+        """The next word distributions and the states after the prompts, see run_prompts
+
+        With the prefix cache, every prompt only runs the words after its longest cached
+        prefix, starting from the cached states, and the states after it are cached.
+        """
+        if self.prefix_cache is None:
+            return self.run_prompts(prompts)
+        cache = self.prefix_cache
+        found = [cache.lookup(prompt) for prompt in prompts]
+        entries = [entry for _, entry in found]
+        todo = [i for i, (length, _) in enumerate(found) if length < len(prompts[i])]
+        if len(todo) > 0:
+            begin_states = [found[i][1].states if found[i][1] is not None else None for i in todo]
+            prob, states = self.run_prompts([prompts[i][found[i][0]:] for i in todo], begin_states)
+            for j, i in enumerate(todo):
+                entries[i] = PrefixEntry(prob[j:j+1].copy(), [state[j:j+1].copy() for state in states])
+                cache.insert(prompts[i], entries[i])
+        prob = mx.nd.concatenate([entry.prob for entry in entries], axis = 0)
+        states = [mx.nd.concatenate([entry.states[k] for entry in entries], axis = 0) 
+            for k in xrange(len(self.state_name))]
+        return prob, states
+
+    def sample(self, prob, top_k = 1, temperature = 1., banned_mask = None):
+        """Sample the next words of prob (batch_size, num_label) on its context
+
+        Among the top_k words of every row, by the Gumbel-max trick on the log probabilities
+        divided by temperature; top_k 1 (or temperature 0) is the greedy decoding.
+        banned_mask: NDArray (1, num_label), 0 for the words never generated, 1 otherwise
+            Outputs:
+                NDArray (batch_size, ), the word ids as float
+        """
+        if banned_mask is not None:
+            prob = mx.nd.broadcast_mul(prob, banned_mask)
+        if top_k == 1 or temperature == 0:
+            return mx.nd.argmax(prob, axis = 1)
+        values, indices = mx.nd.topk(prob, axis = 1, k = top_k, ret_typ = 'both')
+        uniform = mx.random.uniform(1e-10, 1., shape = values.shape, ctx = prob.context)
+        gumbel = -mx.nd.log(-mx.nd.log(uniform))
+        position = mx.nd.argmax(mx.nd.log(mx.nd.maximum(values, 1e-30)) / temperature + gumbel, axis = 1)
+        return mx.nd.sum(indices * mx.nd.one_hot(position, depth = top_k), axis = 1)
+
+    def generate(self, prompts, length, top_k = 1, temperature = 1., banned = None, eos = None):
+        """Generate length words after every prompt, all the prompts are decoded together
+
+            Inputs:
+                prompts: list of word id lists
+                banned: word ids never generated (e.g. pad)
+                eos: the generated sentences are cut after it
+            Outputs:
+                list of generated word id lists
+        """
+        batch_size = len(prompts)
+        prob, states = self.prefill(prompts)
+        executor = self.get_executor(1, batch_size)
+        for name, state in zip(self.state_name, states):
+            state.copyto(executor.arg_dict[name])
+        executor.arg_dict["mask"][:] = 1
+        banned_mask = None
+        if banned is not None and len(banned) > 0:
+            banned_mask = np.ones((1, self.num_label))
+            banned_mask[0, banned] = 0
+            banned_mask = mx.nd.array(banned_mask, self.ctx)
+        words = []
+        for i in xrange(length):
+            word = self.sample(prob, top_k, temperature, banned_mask)
+            word = word.reshape((batch_size, 1))
+            words.append(word)
+            if i == length - 1:
+                break
+            word.copyto(executor.arg_dict["data"])
+            executor.forward()
+            for name, state in zip(self.state_name, executor.outputs[1:]):
+                state.copyto(executor.arg_dict[name])
+            prob = executor.outputs[0]
+        words = mx.nd.concatenate(words, axis = 1).asnumpy().astype('int64')
+        results = []
+        for row in words.tolist():
+            if eos is not None and eos in row:
+                row = row[:row.index(eos) + 1]
+            results.append(row)
+        return results
@@ -44,43 +44,45 @@ model = LSTMInferenceModel(
     num_label = num_label, 
     arg_params = arg_params, 
     ctx = mx.cpu(), 
-    dropout = dropout 
+    dropout = dropout,
+    cache_size = 256
 )
 
 idx2word = {}
 for k, v in word2idx.items():
     idx2word[v] = k
 
-test_str = ['the', 'united', 'states']
-
+# ------------------------------- Generation -------------------------------------
+# the prompts are run through the unrolled graph in one forward (prefill), then all 
+# of them are decoded together, top_k 1 is the greedy decoding
+prompts = [
+    ['the', 'united', 'states'],
+    ['the', 'president', 'said'],
+    ['we', 'are']
+]
 seq_length = 600
-
-data = mx.nd.zeros((1,1))
-mask = mx.nd.ones((1,1))
-
-for i in xrange(seq_length):
-    if i < len(test_str):
-        tmp = np.zeros((1,))
-        if word2idx.get(test_str[i]) is None:
-            tmp[0] = word2idx.get('<UNK>')
-        else:
-            tmp[0] = word2idx.get(test_str[i])
-        print '====================', data[0:1]
-        data[0:1] = tmp[0]
-        prob = model.forward(data, mask)
-    else:
-        tmp = np.zeros((1,))
-        tmp[0] = word2idx.get(test_str[-1])
-
-        data[0:1] = tmp[0]
-        prob = model.forward(data, mask)
-        prob = prob.reshape(-1,)
-        prob = prob.argsort()[::-1]
-        idx = 0
-        while (prob[idx] == word2idx.get('<EOS>') 
-            or prob[idx] == word2idx.get('<PAD>')):
-            idx += 1
-        next_char = idx2word[prob[idx]]
-        test_str.append(next_char)
-
-print test_str
+top_k = 1
+temperature = 1.0
+
+unk = word2idx.get('<unk>')
+prompt_ids = [[word2idx.get(word, unk) for word in prompt] for prompt in prompts]
+results = model.generate(
+    prompt_ids, 
+    length = seq_length, 
+    top_k = top_k, 
+    temperature = temperature, 
+    banned = [word2idx.get('<eos>'), word2idx.get('<pad>')]
+)
+for prompt, result in zip(prompts, results):
+    print ' '.join(prompt + [idx2word[idx] for idx in result])
+
+# the prompts extending the ones above only run their new words
+prompts = [prompt + ['and'] for prompt in prompts] + prompts
+prompt_ids = [[word2idx.get(word, unk) for word in prompt] for prompt in prompts]
+results = model.generate(prompt_ids, length = 20, top_k = 10, temperature = 0.8, 
+    banned = [word2idx.get('<eos>'), word2idx.get('<pad>')])
+for prompt, result in zip(prompts, results):
+    print ' '.join(prompt + [idx2word[idx] for idx in result])
+stats = model.prefix_cache.stats()
+print 'prefix cache: hit rate %.2f, words saved %d / %d, entries %d, evictions %d' % (stats['hit_rate'], 
+    stats['tokens_saved'], stats['tokens'], stats['entries'], stats['evictions'])
@@ -1,3 +1,5 @@
+import itertools
+
 import mxnet as mx
 import numpy as np
 
@@ -43,6 +45,35 @@ class DummyIter(mx.io.DataIter):
 
 DEBUG = False
 
+def flatten_sequences(sequences):
+	"""All the word ids one after the other, shared with seq2seq/enc_dec_iter.py
+		Inputs:
+			sequences: list of word id lists, or an object with the tokens and offsets
+			arrays already (seq2seq corpus_cache.RaggedArray)
+		Outputs:
+			tokens: int32 (total words, ), offsets: int64 (len(sequences) + 1, ),
+			sequence i is tokens[offsets[i]:offsets[i+1]]
+	"""
+	if hasattr(sequences, 'offsets'):
+		return sequences.tokens, np.asarray(sequences.offsets)
+	offsets = np.zeros(len(sequences) + 1, dtype = 'int64')
+	np.cumsum(np.fromiter((len(seq) for seq in sequences), dtype = 'int64', count = len(sequences)), out = offsets[1:])
+	tokens = np.fromiter(itertools.chain.from_iterable(sequences), dtype = 'int32', count = offsets[-1])
+	return tokens, offsets
+
+def scatter_rows(tokens, offsets, rows, width, pad = 0, dtype = 'int32'):
+	"""The (len(rows), width) matrix of the sequences rows (indices into offsets),
+	left aligned and padded with pad, filled in one scatter"""
+	lengths = offsets[rows + 1] - offsets[rows]
+	matrix = np.full((len(rows), width), pad, dtype = dtype)
+	i, j = np.nonzero(np.arange(width) < lengths.reshape(-1, 1))
+	matrix[i, j] = tokens[offsets[rows][i] + j]
+	return matrix
+
+def length_mask(lengths, width):
+	"""float32 (len(lengths), width), 1 on the first lengths[i] positions of row i"""
+	return (np.arange(width) < np.asarray(lengths).reshape(-1, 1)).astype('float32')
+
 class SequenceIter(mx.io.DataIter):
 	def __init__(self, data, label, 
 			pad, init_states, 
@@ -74,25 +105,17 @@ class SequenceIter(mx.io.DataIter):
 		self.default_bucket_key = max(self.buckets)
 		
 		# generate the data , mask, label numpy array
-		data = [[] for _ in self.buckets]
-		mask = [[] for _ in self.buckets]
-		label  = [[] for _ in self.buckets]
-		for i in xrange(self.data_num):
-			bkt_idx = assignments[i]
-			i_data, i_mask, i_label = self.make_data(i, self.buckets[bkt_idx])
-			data[bkt_idx].append(i_data)
-			mask[bkt_idx].append(i_mask)
-			label[bkt_idx].append(i_label)
-
-		self.data = [np.zeros((len(x), self.buckets[i])) for i, x in enumerate(data)]
-		self.mask  = [np.zeros((len(x), self.buckets[i])) for i, x in enumerate(data)]
-		self.label = [np.zeros((len(x), self.buckets[i])) for i, x in enumerate(label)]
-
-		for bkt_idx in xrange(len(self.buckets)):
-			for j in xrange(len(data[bkt_idx])):
-				self.data[bkt_idx][j, :] = data[bkt_idx][j]
-				self.mask[bkt_idx][j, :] = mask[bkt_idx][j]
-				self.label[bkt_idx][j, :] = label[bkt_idx][j]
+		# all the words are concatenated once and scattered into the int32 bucket matrices
+		data_tokens, data_offsets = flatten_sequences(data)
+		label_tokens, label_offsets = flatten_sequences(label)
+		self.data = []
+		self.mask = []
+		self.label = []
+		for bkt_idx, bucket in enumerate(self.buckets):
+			rows = np.nonzero(assignments == bkt_idx)[0]
+			self.data.append(scatter_rows(data_tokens, data_offsets, rows, bucket, self.pad))
+			self.mask.append(length_mask(data_offsets[rows + 1] - data_offsets[rows], bucket))
+			self.label.append(scatter_rows(label_tokens, label_offsets, rows, bucket, self.pad))
 
 		# make a random data iteration plan
 		self.make_data_iter_plan()
@@ -151,31 +174,16 @@ class SequenceIter(mx.io.DataIter):
 		self.label_buffer = []
 
 		for i_bucket in range(len(self.data)):
-			data = np.zeros((self.batch_size, self.buckets[i_bucket]))
-			mask = np.zeros((self.batch_size, self.buckets[i_bucket]))
-			label = np.zeros((self.batch_size, self.buckets[i_bucket]))
+			data = np.zeros((self.batch_size, self.buckets[i_bucket]), dtype = 'float32')
+			mask = np.zeros((self.batch_size, self.buckets[i_bucket]), dtype = 'float32')
+			label = np.zeros((self.batch_size, self.buckets[i_bucket]), dtype = 'float32')
 			self.data_buffer.append(data)
 			self.mask_buffer.append(mask)
 			self.label_buffer.append(label)
 
-	def make_data(self, i, bucket):
-		data = self.data[i]
-		label = self.label[i]
-		
-		i_data = np.full(bucket, self.pad, dtype = float)
-		i_label  = np.full(bucket, self.pad, dtype = float)
-		i_mask = np.zeros(bucket, dtype = float)
-		i_data[:len(data)] = data
-		i_label[:len(label)] = label
-		i_mask[:len(data)] = 1
-		return i_data, i_mask, i_label
-
 	def generate_buckets(self):
-		sequence_length = []
-		for i in xrange(self.data_num):
-			sequence_length.append(len(self.data[i]))
-
-		sequence_length = np.array(sequence_length).reshape(-1,1)
+		sequence_length = np.fromiter((len(seq) for seq in self.data), dtype = 'int64', count = self.data_num)
+		sequence_length = sequence_length.reshape(-1,1)
 		kmeans = KMeans(n_clusters = self.num_buckets, random_state = 1) # use clustering to decide the buckets
 		assignments = kmeans.fit_predict(sequence_length) # get the assignments
 
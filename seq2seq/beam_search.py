@@ -0,0 +1,260 @@
+#coding=utf-8
+
+import time
+
+import mxnet as mx
+import numpy as np
+
+class StatePool(object):
+    '''Preallocated hypothesis states for the beam search
+
+    The pool holds one (batch_size * beam, num_hidden) NDArray per state name, which
+    are the state inputs of the decoder executor themselves. The rows b * beam to
+    (b + 1) * beam belong to the sentence b. The surviving hypotheses are selected
+    with an index gather (take) straight into the pool, so no state is copied per
+    candidate and nothing is allocated per step.
+    The states may also be numpy arrays (numpy_inference.NumpyDecoder).
+    '''
+    def __init__(self, decoder_executor, state_names, beam):
+        super(StatePool, self).__init__()
+        self.state_names = state_names
+        self.beam = beam
+        self.states = [decoder_executor.arg_dict[name] for name in state_names]
+        self.num_rows = self.states[0].shape[0]
+        self.is_numpy = isinstance(self.states[0], np.ndarray)
+        if not self.is_numpy:
+            self.back_pointer = mx.nd.zeros((self.num_rows, ), self.states[0].context)
+
+    def fill(self, init_states):
+        '''init_states: list of NDArray with shape (batch_size, num_hidden), every row is repeated beam times'''
+        for state, init_state in zip(self.states, init_states):
+            if self.is_numpy:
+                state[:] = np.repeat(init_state, self.beam, axis = 0)
+            else:
+                mx.nd.repeat(init_state, repeats = self.beam, axis = 0).copyto(state)
+
+    def select(self, new_states, back_pointer):
+        '''Gather the rows back_pointer of new_states into the pool
+            Inputs:
+                new_states: list of NDArray with shape (batch_size * beam, num_hidden), in the order of state_names
+                back_pointer: numpy array with shape (batch_size * beam, ), the source row of every survivor
+        '''
+        if self.is_numpy:
+            for state, new_state in zip(self.states, new_states):
+                np.take(new_state, back_pointer, axis = 0, out = state)
+            return
+        self.back_pointer[:] = back_pointer
+        for state, new_state in zip(self.states, new_states):
+            mx.nd.take(new_state, self.back_pointer, out = state)
+
+def punctuation_constraints(enc_data, punctuation, num_words):
+    '''Position constraints of the couplet: the lower line has the punctuation of the
+    upper line at the same positions and no punctuation elsewhere
+        Inputs:
+            enc_data: numpy array with shape (batch_size, enc_len), the upper lines
+            punctuation: list of (encoder id, decoder id) of the punctuation words, e.g. ，and 。
+            num_words: decoder vocabulary size
+        Outputs:
+            numpy array with shape (batch_size, enc_len, num_words), the constraints of BeamSearch.search
+    '''
+    enc_data = np.asarray(enc_data)
+    constraints = np.zeros(enc_data.shape + (num_words, ), dtype = 'float32')
+    dec_ids = [dec_id for _, dec_id in punctuation]
+    constraints[:, :, dec_ids] = -np.inf
+    for enc_id, dec_id in punctuation:
+        batch_index, position = np.nonzero(enc_data == enc_id)
+        constraints[batch_index, position, :] = -np.inf
+        constraints[batch_index, position, dec_id] = 0
+    return constraints
+
+class BeamSearch(object):
+    '''Batched beam search over a one-step decoder executor
+
+    The decoder executor is bound with batch size = batch_size * beam, so every
+    live hypothesis of every sentence is advanced with a single forward per time
+    step. After the pruning, the hidden states of the survivors are reordered
+    by back-pointer.
+
+    The decoder executor must take the inputs 'dec_data' with shape (batch_size * beam, 1)
+    and the states in state_names with shape (batch_size * beam, num_hidden), and its
+    outputs must be [softmax, new states in the order of state_names]. Any object with
+    the same arg_dict / forward / outputs on numpy arrays works too (numpy_inference).
+    If the decoder has a 'shortlist' input (shortlist.output_layer), the softmax columns
+    are the words of the shortlist, which must contain pad, eos and unk.
+
+    Args:
+        beam: beam width
+        max_length: max decoding steps
+        min_length: hypotheses ended before this step are dropped
+        keep_ended: whether the hypotheses ended with eos are collected,
+            if False, eos is treated as an invalid word (for couplet)
+        early_stop: stop expanding a sentence once its best ended hypothesis scores at
+            least its best active one, the scores only decrease so none can beat it;
+            its active hypotheses are returned as they are at that step
+        prune_margin: drop the survivors more than prune_margin nats behind the best
+            one of their sentence, None keeps the whole beam
+        deadline: time.time() at which the search returns the hypotheses found so far
+            (anytime search); a step is not started if it would end after the deadline
+            at the mean step time so far. None runs all the steps
+
+    After a search, stats holds:
+        steps: decoder forwards run, steps_saved: max_length - steps
+        expansions: live hypotheses expanded over all the steps
+        expansions_saved: hypothesis slots of the full search (max_length * batch_size * beam)
+            which were not expanded
+        truncated: whether the search was stopped by the deadline
+        incomplete: sentences of a truncated search without any hypothesis ended with eos,
+            all of them with keep_ended = False (couplet): their hypotheses are partial, shorter
+            than max_length, and a caller keeping only the full length lines gets nothing
+    '''
+    def __init__(self, beam, max_length, min_length = 0,
+                pad = 0, eos = 1, unk = 2, keep_ended = True,
+                early_stop = False, prune_margin = None, deadline = None):
+        super(BeamSearch, self).__init__()
+        self.beam = beam
+        self.max_length = max_length
+        self.min_length = min_length
+        self.pad = pad
+        self.eos = eos
+        self.unk = unk
+        self.keep_ended = keep_ended
+        self.early_stop = early_stop
+        self.prune_margin = prune_margin
+        self.deadline = deadline
+        self.stats = {}
+
+    def search(self, decoder_executor, state_names, init_states, feed = None, constraints = None):
+        '''
+            Inputs:
+                decoder_executor: decoder executor bound at batch size = batch_size * beam
+                state_names: names of the decoder state inputs
+                init_states: list of NDArray with shape (batch_size, num_hidden), one per state name
+                feed: function called with seqidx before each forward to set the step inputs
+                constraints: numpy array with shape (batch_size, max_length, num_words) added to the
+                    log probabilities of the step seqidx, -inf bans a word at that position,
+                    so the invalid hypotheses are never expanded
+            Outputs:
+                list of (active_sentences, ended_sentences), one per sentence
+                active_sentences: list of (score, sent) still alive at the last step
+                ended_sentences: list of (score, sent) ended with eos
+        '''
+        beam = self.beam
+        batch_size = init_states[0].shape[0]
+        num_rows = batch_size * beam
+        arg_dict = decoder_executor.arg_dict
+        pool = StatePool(decoder_executor, state_names, beam)
+        pool.fill(init_states)
+
+        # the histories are kept as token / back-pointer arrays, row r of step t
+        # is the t-th word of the hypothesis in row r, coming from row back_pointers[t, r]
+        tokens = np.full((self.max_length + 1, num_rows), self.pad, dtype = 'int64')
+        back_pointers = np.zeros((self.max_length + 1, num_rows), dtype = 'int64')
+        tokens[0, :] = self.eos
+        # only the first hypothesis of every sentence is alive at the beginning
+        scores = np.full((batch_size, beam), -np.inf)
+        scores[:, 0] = 0
+        ended = [[] for _ in xrange(batch_size)]
+        # active hypotheses of the sentences stopped early
+        stopped = [[] for _ in xrange(batch_size)]
+        steps = 0
+        expansions = 0
+        dec_data = np.full((num_rows, 1), self.pad, dtype = 'float32')
+        row_offset = (np.arange(batch_size) * beam).reshape(-1, 1)
+        # the softmax column of every special word, the word id of every column
+        vocab = None
+        eos, unk, pad = self.eos, self.unk, self.pad
+        if 'shortlist' in arg_dict:
+            vocab = arg_dict['shortlist'].asnumpy().astype('int64')
+            column = dict((word, i) for i, word in enumerate(vocab.tolist()))
+            eos, unk, pad = column[self.eos], column[self.unk], column[self.pad]
+            if constraints is not None:
+                constraints = constraints[:, :, vocab]
+        last_step = 0
+        truncated = False
+        start = time.time()
+        for seqidx in xrange(self.max_length):
+            if not np.isfinite(scores).any():
+                break
+            if self.deadline is not None and steps > 0:
+                now = time.time()
+                if now + (now - start) / steps > self.deadline:
+                    truncated = True
+                    break
+            steps += 1
+            expansions += int(np.isfinite(scores).sum())
+            dec_data[:, 0] = tokens[seqidx]
+            arg_dict['dec_data'][:] = dec_data
+            if feed is not None:
+                feed(seqidx)
+            decoder_executor.forward()
+
+            prob = decoder_executor.outputs[0]
+            if not isinstance(prob, np.ndarray):
+                prob = prob.asnumpy()
+            num_words = prob.shape[1]
+            candidates = scores.reshape(-1, 1) + np.log(np.maximum(prob, 1e-30))
+            # a hypothesis ends if eos is in the top beam words of its row
+            if self.keep_ended and seqidx >= self.min_length:
+                eos_rank = (prob > prob[:, eos:eos+1]).sum(axis = 1)
+                rows = np.nonzero((eos_rank < beam) & np.isfinite(scores.reshape(-1)))[0]
+                for row in rows:
+                    ended[row // beam].append((candidates[row, eos], seqidx, row))
+            candidates[:, [eos, unk, pad]] = -np.inf
+            if constraints is not None:
+                candidates = candidates.reshape(batch_size, beam, num_words)
+                candidates += constraints[:, seqidx:seqidx+1, :]
+
+            # prune all the candidates of a sentence at once on its (beam x vocab) matrix
+            candidates = candidates.reshape(batch_size, beam * num_words)
+            best = np.argpartition(-candidates, beam - 1, axis = 1)[:, :beam]
+            best_scores = candidates[np.arange(batch_size).reshape(-1, 1), best]
+            order = np.argsort(-best_scores, axis = 1)
+            best = best[np.arange(batch_size).reshape(-1, 1), order]
+            best_scores = best_scores[np.arange(batch_size).reshape(-1, 1), order]
+            if self.prune_margin is not None:
+                best_scores[best_scores < best_scores[:, :1] - self.prune_margin] = -np.inf
+            if not np.isfinite(best_scores).any():
+                scores = best_scores
+                break
+            rows, words = np.divmod(best, num_words)
+            rows = rows + row_offset
+            tokens[seqidx + 1] = words.reshape(-1) if vocab is None else vocab[words.reshape(-1)]
+            back_pointers[seqidx + 1] = rows.reshape(-1)
+            scores = best_scores
+            last_step = seqidx + 1
+            if self.early_stop and self.keep_ended:
+                for b in xrange(batch_size):
+                    if ended[b] and np.isfinite(scores[b, 0]) and max(ended[b])[0] >= scores[b, 0]:
+                        stopped[b] = [(float(scores[b, k]), self.backtrack(tokens, back_pointers, last_step, b * beam + k))
+                            for k in xrange(beam) if np.isfinite(scores[b, k])]
+                        scores[b, :] = -np.inf
+
+            # reorder the states of the survivors by back-pointer
+            pool.select(decoder_executor.outputs[1:], rows.reshape(-1))
+
+        self.stats = {
+            'steps' : steps,
+            'steps_saved' : self.max_length - steps,
+            'expansions' : expansions,
+            'expansions_saved' : self.max_length * num_rows - expansions,
+            'truncated' : truncated,
+            'incomplete' : sum([1 for b in xrange(batch_size) if truncated and len(ended[b]) == 0])
+        }
+        results = []
+        for b in xrange(batch_size):
+            active_sentences = stopped[b] + [(float(scores[b, k]), self.backtrack(tokens, back_pointers, last_step, b * beam + k))
+                for k in xrange(beam) if np.isfinite(scores[b, k])]
+            ended_sentences = [(float(score), self.backtrack(tokens, back_pointers, step, row) + [self.eos]) 
+                for score, step, row in ended[b]]
+            results.append((active_sentences, ended_sentences))
+        return results
+
+    def backtrack(self, tokens, back_pointers, step, row):
+        '''Materialize the hypothesis in row of step from the back-pointers'''
+        sent = []
+        while step > 0:
+            sent.append(int(tokens[step, row]))
+            row = back_pointers[step, row]
+            step -= 1
+        sent.append(int(tokens[0, row]))
+        return sent[::-1]
@@ -0,0 +1,109 @@
+#-*- coding:utf-8 -*-
+'''Quality / latency curve of the fixed beam search against the deadline (anytime) search
+
+Every sentence of the test file is decoded alone, as an online request, with
+    the fixed beams of --beams, all steps
+    the beam of --deadline-beam under every latency budget of --deadlines
+and for every setting prints the mean / p90 latency, the fraction of truncated
+searches, the fraction of incomplete ones (partial hypotheses only, see BeamSearch stats;
+for couplets they have no full length line), the bleu-1 of the best hypothesis (as train.py)
+and its mean score.
+
+Example:
+    python benchmark.py --task couplet --model global --data-dir ../data/couplet/data/final \
+        --enc-vocab alllist.txt --dec-vocab alllist.txt --share-embed \
+        --params ../data/couplet/global_params/couplet --epoch 6 --test-file test.txt
+'''
+
+import os, argparse, time, codecs
+from collections import defaultdict
+
+import mxnet as mx
+import numpy as np
+from nltk.translate.bleu_score import corpus_bleu
+
+from inference import InferenceSession
+from beam_search import punctuation_constraints
+from server import add_model_arguments, load_model
+
+def read_test_file(path, enc_word2idx, num):
+    '''Outputs: list of (word ids of the post, list of reference word lists)'''
+    with codecs.open(path, 'r', encoding = 'utf-8', errors = 'ignore') as f:
+        lines = f.readlines()
+    dic = defaultdict(list)
+    keys = []
+    for line in lines:
+        line_list = line.strip().split('\t=>\t')
+        if len(line_list) != 2:
+            continue
+        key = line_list[0].strip()
+        if key not in dic:
+            keys.append(key)
+        dic[key].append(line_list[1].strip().split())
+    unk = enc_word2idx.get('<unk>')
+    return [([enc_word2idx.get(item, unk) for item in key.split()], dic[key]) for key in keys[:num]]
+
+def run(session, posts, task, dec_word2idx, punctuation, deadline = None):
+    dec_idx2word = dict((v, k) for k, v in dec_word2idx.items())
+    # bind all the executors before the timing, the session has to keep them all
+    for data, _ in posts:
+        session.get(len(data))
+    binds = session.binds
+    latencies, truncated, incomplete, scores = [], [], [], []
+    hypotheses, references = [], []
+    for data, refs in posts:
+        enc_data = mx.nd.array(np.array(data).reshape(1, -1))
+        start = time.time()
+        if task == 'couplet':
+            constraints = punctuation_constraints(enc_data.asnumpy(), punctuation, len(dec_word2idx))
+            results = session.couplet_predict(enc_data, constraints = constraints, deadline = deadline)
+        else:
+            results = session.predict(enc_data, deadline = deadline)
+        latencies.append(time.time() - start)
+        stats = session.get(len(data))[0].search_stats
+        truncated.append(stats['truncated'])
+        incomplete.append(stats['incomplete'] > 0)
+        if len(results) > 0:
+            scores.append(results[0][0])
+            hypotheses.append([dec_idx2word[idx] for idx in results[0][1] if dec_idx2word[idx] != '<eos>'])
+        else:
+            hypotheses.append([])
+        references.append(refs)
+    assert session.binds == binds, 'executors bound inside the timing, max_cached is too small'
+    bleu = corpus_bleu(references, hypotheses, weights = (1,), smoothing_function = None)
+    latencies = np.array(latencies) * 1000
+    return latencies.mean(), np.percentile(latencies, 90), np.mean(truncated), np.mean(incomplete), bleu, np.mean(scores)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Beam search quality / latency benchmark')
+    add_model_arguments(parser)
+    parser.add_argument('--test-file', default = 'test.txt', type = str, help = 'post\\t=>\\tcmnt file in data-dir')
+    parser.add_argument('--num', default = 300, type = int, help = 'number of test posts')
+    parser.add_argument('--beams', default = '1,5,10,20', type = str, help = 'fixed beams')
+    parser.add_argument('--deadline-beam', default = None, type = int, help = 'default 20 for couplet, 10 otherwise')
+    parser.add_argument('--deadlines', default = '0.005,0.01,0.02,0.05', type = str, help = 'latency budgets in seconds')
+    args = parser.parse_args()
+
+    Model, enc_word2idx, dec_word2idx, arg_params, model_args = load_model(args)
+    posts = read_test_file(os.path.join(args.data_dir, args.test_file), enc_word2idx, args.num)
+    punctuation = [(enc_word2idx[w], dec_word2idx[w]) for w in [u'，', u'。']
+        if w in enc_word2idx and w in dec_word2idx]
+    deadline_beam = args.deadline_beam
+    if deadline_beam is None:
+        deadline_beam = 20 if args.task == 'couplet' else 10
+
+    settings = [(int(beam), None) for beam in args.beams.split(',')]
+    settings += [(deadline_beam, float(deadline)) for deadline in args.deadlines.split(',')]
+    print '%-24s %10s %10s %10s %10s %8s %10s' % ('setting', 'mean ms', 'p90 ms', 'truncated', 'incomplete', 'bleu-1', 'score')
+    sessions = {}
+    num_lengths = len(set([len(data) for data, _ in posts]))
+    for beam, deadline in settings:
+        if beam not in sessions:
+            sessions[beam] = InferenceSession(Model, arg_params, beam = beam, 
+                max_cached = InferenceSession.cache_size(num_lengths), **model_args)
+        mean, p90, truncated, incomplete, bleu, score = run(sessions[beam], posts, args.task, dec_word2idx, punctuation, deadline)
+        if deadline is None:
+            name = 'beam %d' % beam
+        else:
+            name = 'beam %d, deadline %gms' % (beam, deadline * 1000)
+        print '%-24s %10.2f %10.2f %10.2f %10.2f %8.4f %10.4f' % (name, mean, p90, truncated, incomplete, bleu, score)
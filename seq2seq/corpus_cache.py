@@ -0,0 +1,133 @@
+#-*- coding:utf-8 -*-
+'''Compiled binary cache of the "post\t=>\tcmnt" corpora
+
+The first run tokenizes the corpus once (line by line, the same pairs as
+enc_dec_iter.get_enc_dec_text_id) and writes, for the encoder and the decoder sides,
+    <key>.enc.tokens / <key>.dec.tokens: the word ids of all the sentences, flat int32
+    <key>.enc.offsets / <key>.dec.offsets: int64, sentence i is tokens[offsets[i]:offsets[i+1]]
+the key is the md5 of the corpus path, size and modification time, of the two vocabularies
+and of CACHE_VERSION (the corpus itself is not read to find the cache, so an edit keeping
+the same size within the mtime granularity of the filesystem is not seen: remove the
+cache files in that case). The later runs
+memory-map the files, nothing is tokenized and the corpus is never held in python lists.
+
+Example:
+    enc_train, dec_train = load_enc_dec_corpus(os.path.join(data_dir, 'train.txt'), enc_word2idx, dec_word2idx)
+'''
+
+import os, json, hashlib, codecs
+
+import numpy as np
+
+# change it when the layout of the cache files changes
+CACHE_VERSION = 1
+
+class RaggedArray(object):
+    '''Sentences of variable length stored in one flat array
+
+    Indexing gives the word ids of a sentence (a numpy view), so it can replace the
+    list of word id lists of get_enc_dec_text_id.
+    Args:
+        tokens: 1-D int array, all the sentences one after the other
+        offsets: 1-D int array of len(sentences) + 1
+    '''
+    def __init__(self, tokens, offsets):
+        super(RaggedArray, self).__init__()
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+def corpus_key(path, enc_word2idx, dec_word2idx):
+    '''md5 of the corpus path, size and modification time, of the two vocabularies
+    and of CACHE_VERSION'''
+    md5 = hashlib.md5()
+    stat = os.stat(path)
+    md5.update(repr((os.path.abspath(path), stat.st_size, stat.st_mtime, CACHE_VERSION)))
+    for word2idx in [enc_word2idx, dec_word2idx]:
+        for word, idx in sorted(word2idx.items()):
+            md5.update(('%s\t%d\n' % (word, idx)).encode('utf-8'))
+    return md5.hexdigest()
+
+def compile_corpus(path, enc_word2idx, dec_word2idx, prefix, chunk_size = 100000):
+    '''Tokenize the corpus of path to the files of prefix, see the module documentation
+        Outputs:
+            number of pairs
+    '''
+    enc_unk = enc_word2idx.get('<unk>')
+    dec_unk = dec_word2idx.get('<unk>')
+    tmp = prefix + '.tmp'
+    files = dict((name, open('%s.%s' % (tmp, name), 'wb'))
+        for name in ['enc.tokens', 'dec.tokens', 'enc.lengths', 'dec.lengths'])
+    buffers = dict((name, []) for name in files)
+    def flush():
+        for name, buf in buffers.items():
+            np.array(buf, dtype = 'int32').tofile(files[name])
+            del buf[:]
+    num_pairs = 0
+    with codecs.open(path, 'r', encoding = 'utf-8', errors = 'ignore') as fid:
+        for line in fid:
+            line_list = line.strip().split('\t=>\t')
+            for i in xrange(1, len(line_list)):
+                enc = [enc_word2idx.get(word, enc_unk) for word in line_list[0].strip().split()]
+                dec = [dec_word2idx.get(word, dec_unk) for word in line_list[i].strip().split()]
+                buffers['enc.tokens'].extend(enc)
+                buffers['dec.tokens'].extend(dec)
+                buffers['enc.lengths'].append(len(enc))
+                buffers['dec.lengths'].append(len(dec))
+                num_pairs += 1
+                if len(buffers['enc.lengths']) >= chunk_size:
+                    flush()
+    flush()
+    for f in files.values():
+        f.close()
+    for side in ['enc', 'dec']:
+        lengths = np.fromfile('%s.%s.lengths' % (tmp, side), dtype = 'int32')
+        offsets = np.zeros(len(lengths) + 1, dtype = 'int64')
+        np.cumsum(lengths, out = offsets[1:])
+        offsets.tofile('%s.%s.offsets' % (prefix, side))
+        os.remove('%s.%s.lengths' % (tmp, side))
+        os.rename('%s.%s.tokens' % (tmp, side), '%s.%s.tokens' % (prefix, side))
+    # written last, the cache is complete once it exists
+    with open(prefix + '.json', 'w') as f:
+        json.dump({'corpus' : os.path.abspath(path), 'pairs' : num_pairs}, f)
+    return num_pairs
+
+def load_enc_dec_corpus(path, enc_word2idx, dec_word2idx, cache_dir = None):
+    '''Same pairs as get_enc_dec_text_id, as two memory-mapped RaggedArray
+
+    The corpus is compiled into cache_dir (default: corpus_cache next to the corpus)
+    if it is not there yet.
+        Outputs:
+            enc_data, dec_data
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'corpus_cache')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    prefix = os.path.join(cache_dir, corpus_key(path, enc_word2idx, dec_word2idx))
+    if not os.path.exists(prefix + '.json'):
+        print 'Compiling the corpus %s to %s' % (path, prefix)
+        compile_corpus(path, enc_word2idx, dec_word2idx, prefix)
+    result = []
+    for side in ['enc', 'dec']:
+        offsets = np.memmap('%s.%s.offsets' % (prefix, side), dtype = 'int64', mode = 'r')
+        if offsets[-1] > 0:
+            tokens = np.memmap('%s.%s.tokens' % (prefix, side), dtype = 'int32', mode = 'r')
+        else:
+            # numpy can not map an empty file
+            tokens = np.zeros(0, dtype = 'int32')
+        result.append(RaggedArray(tokens, offsets))
+    return result[0], result[1]
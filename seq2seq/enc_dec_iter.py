@@ -1,3 +1,4 @@
+import sys
 import logging
 import codecs
 import re
@@ -7,6 +8,9 @@ from collections import namedtuple
 import mxnet as mx
 import numpy as np
 from sklearn.cluster import KMeans
+sys.path.append('..')
+# the word id matrices are built with the helpers of SequenceIter
+from rnn.sequence_iter import flatten_sequences, scatter_rows, length_mask
 
 def generate_buckets(enc_dec_data, num_buckets):
     enc_dec_data = np.array(enc_dec_data)
@@ -58,13 +62,36 @@ def get_enc_dec_text_id(path, enc_word2idx, dec_word2idx):
                 index += 1
     return enc_data, dec_data
 
-
+def make_bucket_arrays(enc_tokens, enc_offsets, dec_tokens, dec_offsets, rows, bucket, pad = 0, eos = 1):
+    '''The arrays of the pairs rows in bucket (enc_len, dec_len), with the layout
+        enc_data: the encoder words, enc_mask: 1 on them
+        dec_data: eos then the decoder words, dec_mask: 1 on them
+        label: the decoder words then eos
+    enc_data, dec_data and label are int32, the masks float32
+    '''
+    enc_len, dec_len = bucket
+    rows = np.asarray(rows, dtype = 'int64')
+    enc_lengths = enc_offsets[rows + 1] - enc_offsets[rows]
+    dec_lengths = dec_offsets[rows + 1] - dec_offsets[rows]
+    enc_data = scatter_rows(enc_tokens, enc_offsets, rows, enc_len, pad)
+    label = scatter_rows(dec_tokens, dec_offsets, rows, dec_len, pad)
+    label[np.arange(len(rows)), dec_lengths] = eos
+    # the decoder input is the label shifted right behind eos, without the final eos
+    dec_data = np.empty_like(label)
+    dec_data[:, 0] = eos
+    dec_data[:, 1:] = label[:, :-1]
+    ends = dec_lengths + 1
+    inside = ends < dec_len
+    dec_data[np.arange(len(rows))[inside], ends[inside]] = pad
+    return enc_data, length_mask(enc_lengths, enc_len), dec_data, length_mask(dec_lengths + 1, dec_len), label
 
 class EncoderDecoderIter(mx.io.DataIter):
     """This iterator is specially defined for the Couplet Generation
     
+    The pairs longer than the largest bucket are skipped (counted in self.skipped),
+    as StreamingEncoderDecoderIter does.
     """
-    def __init__(self, enc_data, dec_data, batch_size, buckets, shuffle=True, pad=0, eos=1):
+    def __init__(self, enc_data, dec_data, batch_size, buckets, shuffle=True, pad=0, eos=1, length_inputs=False):
         
         super(EncoderDecoderIter, self).__init__()
         # initilization
@@ -75,29 +102,40 @@ class EncoderDecoderIter(mx.io.DataIter):
         self.eos = eos
         self.batch_size = batch_size
         self.shuffle = shuffle
+        # only the word ids and the lengths for the models with length_inputs (length_inputs.py)
+        self.length_inputs = length_inputs
 
         self.data_names = ['enc_data', 'enc_mask', 'dec_data', 'dec_mask']
         self.label_names = ['label']
+        if self.length_inputs:
+            self.data_names = ['enc_data', 'enc_length', 'dec_data', 'dec_length']
+            self.label_names = []
         # process buckets
         self.buckets = sorted(buckets)
         enc_len = max([bucket[0] for bucket in self.buckets])
         dec_len = max([bucket[1] for bucket in self.buckets])
         self.default_bucket_key = (enc_len, dec_len)
-        self.assignments = []
-        for idx in range(self.data_len):
-            for bkt in range(len(self.buckets)):
-                if len(self.enc_data[idx]) <= self.buckets[bkt][0] and len(self.dec_data[idx]) <= self.buckets[bkt][1]:
-                    break
-            self.assignments.append(bkt)
-        buckets_count = [0 for i in range(len(self.buckets))]
-        for idx in self.assignments:
-            buckets_count[idx] += 1
+        # the pairs go to the first bucket they fit, -1 (skipped) if none
+        self.enc_tokens, self.enc_offsets = flatten_sequences(enc_data)
+        self.dec_tokens, self.dec_offsets = flatten_sequences(dec_data)
+        enc_lengths = np.diff(self.enc_offsets)
+        dec_lengths = np.diff(self.dec_offsets)
+        self.assignments = np.full(self.data_len, -1, dtype = 'int64')
+        for bkt in reversed(range(len(self.buckets))):
+            fits = (enc_lengths <= self.buckets[bkt][0]) & (dec_lengths + 1 <= self.buckets[bkt][1])
+            self.assignments[fits] = bkt
+        self.skipped = int(np.sum(self.assignments < 0))
+        buckets_count = np.bincount(self.assignments[self.assignments >= 0], minlength = len(self.buckets)).tolist()
         print 'buckets: ', self.buckets
         print 'buckets_count: ', buckets_count
+        print 'skipped (longer than the largest bucket): ', self.skipped
         print 'default_bucket_key: ', self.default_bucket_key
         
-        # generate the data , mask, label numpy array
-        self.enc_data, self.enc_mask, self.dec_data, self.dec_mask, self.label = self.make_numpy_array()
+        # only the word ids (uint16 for the small vocabularies) and the lengths are stored, 
+        # the masks, the decoder input and the label are made at batch time
+        self.enc_data, self.enc_lengths, self.dec_data, self.dec_lengths = self.make_numpy_array()
+        del self.enc_tokens, self.enc_offsets, self.dec_tokens, self.dec_offsets
+        self.buffers = [None for _ in self.buckets]
 
         # make a random data iteration plan
         self.plan = []
@@ -124,14 +162,10 @@ class EncoderDecoderIter(mx.io.DataIter):
         self.curr_plan += 1
         index = self.idx[i][j:j+self.batch_size] 
 
-        enc_data = mx.nd.array(self.enc_data[i][index])
-        enc_mask = mx.nd.array(self.enc_mask[i][index])
-        dec_data = mx.nd.array(self.dec_data[i][index])
-        dec_mask = mx.nd.array(self.dec_mask[i][index])      
-        label = mx.nd.array(self.label[i][index])
+        arrays = [mx.nd.array(array) for array in self.make_batch(i, index)]
 
-        data_all = [enc_data, enc_mask, dec_data, dec_mask]
-        label_all = [label]
+        data_all = arrays[:4]
+        label_all = arrays[4:]
 
         data_names = self.data_names
         label_names = self.label_names
@@ -146,55 +180,224 @@ class EncoderDecoderIter(mx.io.DataIter):
 
     @property
     def provide_data(self):
-        return [('enc_data' , (self.batch_size, self.default_bucket_key[0])),
-                  ('enc_mask' , (self.batch_size, self.default_bucket_key[0])),
-                  ('dec_data' , (self.batch_size, self.default_bucket_key[1])),
-                  ('dec_mask' , (self.batch_size, self.default_bucket_key[1]))] 
+        return provide_shapes(self.batch_size, self.default_bucket_key, self.length_inputs)[0]
 
     @property
     def provide_label(self):
-        return [('label', (self.batch_size, self.default_bucket_key[1]))]
-        
-    def make_data_line(self, i, bucket):
-        data = self.enc_data[i]
-        label = self.dec_data[i]
-        enc_len = bucket[0]
-        dec_len = bucket[1]
-        ed = np.full(enc_len, self.pad, dtype = float)
-        dd = np.full(dec_len, self.pad, dtype = float)
-        em = np.zeros(enc_len, dtype = float)
-        dm = np.zeros(dec_len, dtype = float)      
-        l  = np.full(dec_len, self.pad, dtype = float)
+        return provide_shapes(self.batch_size, self.default_bucket_key, self.length_inputs)[1]
         
-        #ed[enc_len-len(data):enc_len] = data
-        #em[enc_len-len(data):enc_len] = 1.0
-        ed[0:len(data)] = data
-        em[0:len(data)] = 1.0
-        dd[0] = self.eos
-        dd[1:len(label)+1] = label 
-        dm[0:len(label)+1] = 1.0
-        l[0:len(label)] = label
-        l[len(label)] = self.eos
-        return ed, em, dd, dm, l
-
     def make_numpy_array(self):
-        enc_data = [[] for _ in self.buckets]
-        enc_mask = [[] for _ in self.buckets]
-        dec_data = [[] for _ in self.buckets]
-        dec_mask = [[] for _ in self.buckets]
-        label  = [[] for _ in self.buckets]
-
-        for i in xrange(self.data_len):
-            bkt_idx = self.assignments[i]
-            ed, em, dd, dm, l = self.make_data_line(i, self.buckets[bkt_idx])
-            enc_data[bkt_idx].append(ed)
-            enc_mask[bkt_idx].append(em)
-            dec_data[bkt_idx].append(dd)
-            dec_mask[bkt_idx].append(dm)
-            label[bkt_idx].append(l)
-        enc_data = [np.asarray(i, dtype='float32') for i in enc_data]
-        enc_mask  = [np.asarray(i, dtype='float32') for i in enc_mask]
-        dec_data = [np.asarray(i, dtype='float32') for i in dec_data]
-        dec_mask  = [np.asarray(i, dtype='float32') for i in dec_mask]
-        label = [np.asarray(i, dtype='float32') for i in label]
-        return enc_data, enc_mask, dec_data, dec_mask, label
\ No newline at end of file
+        '''Outputs, one per bucket:
+            enc_data (pairs, enc_len), enc_lengths, dec_data (pairs, dec_len - 1): the decoder
+            words without eos, dec_lengths
+        '''
+        num_words = max(self.enc_tokens.max() if len(self.enc_tokens) > 0 else 0, 
+            self.dec_tokens.max() if len(self.dec_tokens) > 0 else 0, self.pad, self.eos) + 1
+        dtype = 'uint16' if num_words <= 1 << 16 else 'int32'
+        enc_data, enc_lengths, dec_data, dec_lengths = [], [], [], []
+        for bkt_idx, (enc_len, dec_len) in enumerate(self.buckets):
+            rows = np.nonzero(self.assignments == bkt_idx)[0]
+            enc_data.append(scatter_rows(self.enc_tokens, self.enc_offsets, rows, enc_len, self.pad, dtype))
+            enc_lengths.append((self.enc_offsets[rows + 1] - self.enc_offsets[rows]).astype('int32'))
+            dec_data.append(scatter_rows(self.dec_tokens, self.dec_offsets, rows, dec_len - 1, self.pad, dtype))
+            dec_lengths.append((self.dec_offsets[rows + 1] - self.dec_offsets[rows]).astype('int32'))
+        return enc_data, enc_lengths, dec_data, dec_lengths
+
+    def make_batch(self, i, index):
+        '''enc_data, enc_mask, dec_data, dec_mask, label of the pairs index of bucket i
+        (enc_data, enc_length, dec_data, dec_length with length_inputs), written into the
+        float32 buffers of the bucket (reused by every batch)'''
+        enc_len, dec_len = self.buckets[i]
+        if self.buffers[i] is None:
+            if self.length_inputs:
+                shapes = [(enc_len, ), (), (dec_len, ), ()]
+            else:
+                shapes = [(enc_len, ), (enc_len, ), (dec_len, ), (dec_len, ), (dec_len, )]
+            self.buffers[i] = [np.zeros((self.batch_size, ) + shape, dtype = 'float32') for shape in shapes]
+        buffers = self.buffers[i]
+        enc_lengths = self.enc_lengths[i][index]
+        dec_lengths = self.dec_lengths[i][index]
+        words = self.dec_data[i][index]
+        enc_data, dec_data = buffers[0], buffers[2]
+        enc_data[:] = self.enc_data[i][index]
+        # eos then the words
+        dec_data[:, 0] = self.eos
+        dec_data[:, 1:] = words
+        if self.length_inputs:
+            buffers[1][:] = enc_lengths
+            buffers[3][:] = dec_lengths
+            return buffers
+        enc_mask, dec_mask, label = buffers[1], buffers[3], buffers[4]
+        np.less(np.arange(enc_len), enc_lengths.reshape(-1, 1), out = enc_mask)
+        np.less(np.arange(dec_len), dec_lengths.reshape(-1, 1) + 1, out = dec_mask)
+        # the words then eos
+        label[:, :-1] = words
+        label[:, -1] = self.pad
+        label[np.arange(len(index)), dec_lengths] = self.eos
+        return buffers
+
+def provide_shapes(batch_size, bucket, length_inputs = False):
+    '''(provide_data, provide_label) of the iterators at bucket (enc_len, dec_len),
+    with length_inputs the lengths replace the masks and there is no label
+    '''
+    enc_len, dec_len = bucket
+    if length_inputs:
+        return ([('enc_data', (batch_size, enc_len)), ('enc_length', (batch_size, )),
+            ('dec_data', (batch_size, dec_len)), ('dec_length', (batch_size, ))], [])
+    return ([('enc_data', (batch_size, enc_len)), ('enc_mask', (batch_size, enc_len)),
+        ('dec_data', (batch_size, dec_len)), ('dec_mask', (batch_size, dec_len))], 
+        [('label', (batch_size, dec_len))])
+
+def pad_batch(pairs, bucket, pad = 0, eos = 1):
+    '''The float32 arrays enc_data, enc_mask, dec_data, dec_mask, label of a batch
+    of (enc word ids, dec word ids) pairs, the layout of make_bucket_arrays'''
+    enc_tokens, enc_offsets = flatten_sequences([enc for enc, _ in pairs])
+    dec_tokens, dec_offsets = flatten_sequences([dec for _, dec in pairs])
+    arrays = make_bucket_arrays(enc_tokens, enc_offsets, dec_tokens, dec_offsets, 
+        np.arange(len(pairs)), bucket, pad, eos)
+    return [array.astype('float32') for array in arrays]
+
+class RaggedPairs(object):
+    '''Pair source of StreamingEncoderDecoderIter over two indexable corpora
+    (corpus_cache.RaggedArray or lists), read chunk_size pairs at a time
+
+    With shuffle, the chunks are visited in a random order every epoch, each chunk is
+    still read contiguously (sequential reads of the memory-mapped files).
+    '''
+    def __init__(self, enc_data, dec_data, chunk_size = 10000):
+        super(RaggedPairs, self).__init__()
+        self.enc_data = enc_data
+        self.dec_data = dec_data
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.enc_data)
+
+    def __call__(self, shuffle = False):
+        starts = range(0, len(self.enc_data), self.chunk_size)
+        if shuffle:
+            random.shuffle(starts)
+        for start in starts:
+            for i in xrange(start, min(start + self.chunk_size, len(self.enc_data))):
+                yield self.enc_data[i], self.dec_data[i]
+
+class TextPairs(object):
+    '''Pair source of StreamingEncoderDecoderIter reading a "post\t=>\tcmnt" file line by line,
+    the same pairs as get_enc_dec_text_id'''
+    def __init__(self, path, enc_word2idx, dec_word2idx):
+        super(TextPairs, self).__init__()
+        self.path = path
+        self.enc_word2idx = enc_word2idx
+        self.dec_word2idx = dec_word2idx
+
+    def __call__(self, shuffle = False):
+        enc_unk = self.enc_word2idx.get('<unk>')
+        dec_unk = self.dec_word2idx.get('<unk>')
+        with codecs.open(self.path, 'r', encoding='utf-8', errors='ignore') as fid:
+            for line in fid:
+                line_list = line.strip().split('\t=>\t')
+                for i in xrange(1, len(line_list)):
+                    enc = [self.enc_word2idx.get(word, enc_unk) for word in line_list[0].strip().split()]
+                    dec = [self.dec_word2idx.get(word, dec_unk) for word in line_list[i].strip().split()]
+                    yield enc, dec
+
+class StreamingEncoderDecoderIter(mx.io.DataIter):
+    """EncoderDecoderIter over a stream of pairs in bounded memory
+
+    The pairs of source (RaggedPairs or TextPairs) go through a shuffle buffer of
+    buffer_size pairs, every pair leaving the buffer is put into the first bucket it
+    fits and a batch is emitted as soon as a bucket has batch_size pairs. At most
+    buffer_size + len(buckets) * batch_size pairs are held, whatever the corpus size.
+    The pairs longer than the largest bucket are skipped, the incomplete batches left
+    at the end of an epoch are dropped (as EncoderDecoderIter).
+    Same data names, provide_data / provide_label and bucket_key as EncoderDecoderIter
+    (length_inputs as well).
+    """
+    def __init__(self, source, batch_size, buckets, shuffle=True, pad=0, eos=1, buffer_size=100000, length_inputs=False):
+        super(StreamingEncoderDecoderIter, self).__init__()
+        self.source = source
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pad = pad
+        self.eos = eos
+        self.buffer_size = buffer_size if shuffle else 1
+        self.data_len = len(source) if hasattr(source, '__len__') else None
+        self.length_inputs = length_inputs
+
+        self.data_names = ['enc_data', 'enc_mask', 'dec_data', 'dec_mask']
+        self.label_names = ['label']
+        if self.length_inputs:
+            self.data_names = ['enc_data', 'enc_length', 'dec_data', 'dec_length']
+            self.label_names = []
+        self.buckets = sorted(buckets)
+        enc_len = max([bucket[0] for bucket in self.buckets])
+        dec_len = max([bucket[1] for bucket in self.buckets])
+        self.default_bucket_key = (enc_len, dec_len)
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        self.pairs = self.source(self.shuffle)
+        self.buffer = []
+        self.pending = [[] for _ in self.buckets]
+        self.exhausted = False
+
+    def bucket_of(self, enc, dec):
+        # the decoder side has the eos added
+        for i, (enc_len, dec_len) in enumerate(self.buckets):
+            if len(enc) <= enc_len and len(dec) + 1 <= dec_len:
+                return i
+        return None
+
+    def next_pair(self):
+        '''The next pair out of the shuffle buffer, None at the end of the epoch'''
+        while not self.exhausted and len(self.buffer) < self.buffer_size:
+            try:
+                self.buffer.append(next(self.pairs))
+            except StopIteration:
+                self.exhausted = True
+        if len(self.buffer) == 0:
+            return None
+        if self.shuffle:
+            k = random.randrange(len(self.buffer))
+            self.buffer[k], self.buffer[-1] = self.buffer[-1], self.buffer[k]
+            return self.buffer.pop()
+        return self.buffer.pop(0)
+
+    def next(self):
+        while True:
+            pair = self.next_pair()
+            if pair is None:
+                raise StopIteration
+            i = self.bucket_of(*pair)
+            if i is None:
+                self.skipped += 1
+                continue
+            self.pending[i].append(pair)
+            if len(self.pending[i]) == self.batch_size:
+                pairs, self.pending[i] = self.pending[i], []
+                return self.make_batch(pairs, self.buckets[i])
+
+    def make_batch(self, pairs, bucket):
+        arrays = pad_batch(pairs, bucket, self.pad, self.eos)
+        if self.length_inputs:
+            arrays = [arrays[0], np.array([len(enc) for enc, _ in pairs], dtype = 'float32'),
+                arrays[2], np.array([len(dec) for _, dec in pairs], dtype = 'float32')]
+        arrays = [mx.nd.array(array) for array in arrays]
+        data_all = arrays[:4]
+        label_all = arrays[4:]
+        return mx.io.DataBatch(
+            data = data_all,
+            label = label_all,
+            bucket_key = bucket,
+            provide_data = zip(self.data_names, [data.shape for data in data_all]),
+            provide_label = zip(self.label_names, [label.shape for label in label_all])
+        )
+
+    @property
+    def provide_data(self):
+        return provide_shapes(self.batch_size, self.default_bucket_key, self.length_inputs)[0]
+
+    @property
+    def provide_label(self):
+        return provide_shapes(self.batch_size, self.default_bucket_key, self.length_inputs)[1]
@@ -1,7 +1,7 @@
 #-*- coding:utf-8 -*-
 
 import re, os, sys, argparse, logging, collections
-import codecs
+import codecs, json, math, time
 from collections import namedtuple, defaultdict
 from nltk.translate.bleu_score import corpus_bleu
 import matplotlib 
@@ -13,7 +13,7 @@ import numpy as np
 
 def read_file(file):
     with codecs.open(file, 'r', encoding='utf-8', errors='ignore') as fid:
-        lines = fid.readlines()[:3000]
+        lines = fid.readlines()
     index = 0
     list_of_references = []
     list_of_hypothesis = []
@@ -28,6 +28,138 @@ def read_file(file):
         index += 1
     return list_of_hypothesis, list_of_references
 
+def write_record(f, index, source, references, nbest):
+    '''Append one generate record (a JSON line) to the open file f and flush it, so the
+    evaluation can follow the file while the generation runs
+        Inputs:
+            index: position of the post in the test set
+            source: word ids of the post
+            references: list of word id lists
+            nbest: list of (score, word ids)
+    '''
+    record = {
+        'index' : index,
+        'source' : [int(idx) for idx in source],
+        'references' : [[int(idx) for idx in ref] for ref in references],
+        'nbest' : [{'score' : float(score), 'tokens' : [int(idx) for idx in sent]} for score, sent in nbest]
+    }
+    f.write(json.dumps(record) + '\n')
+    f.flush()
+
+def write_end(f, count):
+    '''The last record, the readers following the file stop on it'''
+    f.write(json.dumps({'end' : True, 'count' : count}) + '\n')
+    f.flush()
+
+def read_records(path, follow = False, interval = 1.):
+    '''Yield the generate records of path one by one
+
+    With follow, wait for the records still being written (and for the file to
+    exist) until the end record, otherwise stop at the end of the file.
+    '''
+    while follow and not os.path.exists(path):
+        time.sleep(interval)
+    with open(path, 'r') as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):
+                # end of file, or a record not completely written yet
+                partial += line
+                if not follow:
+                    break
+                time.sleep(interval)
+                continue
+            line, partial = partial + line, ''
+            if len(line.strip()) == 0:
+                continue
+            record = json.loads(line)
+            if record.get('end'):
+                break
+            yield record
+
+def merge_records(paths, path):
+    '''Merge the records files of the decoding workers into path, in the order of
+    their post index, returns the number of records'''
+    records = []
+    for shard_path in paths:
+        records.extend(read_records(shard_path))
+    records.sort(key = lambda record: record['index'])
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        write_end(f, len(records))
+    return len(records)
+
+class IncrementalBleu(object):
+    '''Corpus BLEU accumulated sentence by sentence, the same value as
+    nltk corpus_bleu(list_of_references, list_of_hypothesis, weights) without smoothing
+
+    The clipped n-gram counts and the lengths are summed as the sentences are added,
+    so the score of a stream is available at any time without keeping the sentences.
+    '''
+    def __init__(self, weights = (1,)):
+        super(IncrementalBleu, self).__init__()
+        self.weights = weights
+        self.numerators = [0] * len(weights)
+        self.denominators = [0] * len(weights)
+        self.hyp_length = 0
+        self.ref_length = 0
+        self.count = 0
+
+    def add(self, references, hypothesis):
+        for i in xrange(len(self.weights)):
+            n = i + 1
+            counts = collections.Counter(tuple(hypothesis[k:k+n]) for k in xrange(len(hypothesis) - n + 1))
+            max_counts = {}
+            for reference in references:
+                reference_counts = collections.Counter(tuple(reference[k:k+n]) for k in xrange(len(reference) - n + 1))
+                for ngram in counts:
+                    max_counts[ngram] = max(max_counts.get(ngram, 0), reference_counts[ngram])
+            self.numerators[i] += sum(min(count, max_counts[ngram]) for ngram, count in counts.items())
+            self.denominators[i] += max(1, sum(counts.values()))
+        hyp_len = len(hypothesis)
+        self.hyp_length += hyp_len
+        self.ref_length += min([len(ref) for ref in references], key = lambda ref_len: (abs(ref_len - hyp_len), ref_len))
+        self.count += 1
+
+    def bleu(self):
+        if min(self.numerators) == 0:
+            return 0.
+        if self.hyp_length > self.ref_length:
+            bp = 1.
+        else:
+            bp = math.exp(1 - float(self.ref_length) / self.hyp_length)
+        return bp * math.exp(sum(w * math.log(float(num) / den)
+            for w, num, den in zip(self.weights, self.numerators, self.denominators)))
+
+def records_bleu(path, eos = None, nbest = None, follow = False, weights = (1,), report = 0):
+    '''BLEU of the records of path, read incrementally
+
+    As read_file on the text generate files: every n-best line of a record is a hypothesis
+    (scored against the references of its record) and the records without results are skipped.
+        Inputs:
+            eos: word id removed from the hypotheses and references
+            nbest: only the first nbest lines of every record (1: the best hypothesis only),
+                None all of them
+            follow: evaluate while the file is being written, see read_records
+            report: print the running score every report records, 0 never
+        Outputs:
+            (bleu, number of hypotheses)
+    '''
+    metric = IncrementalBleu(weights)
+    records = 0
+    for record in read_records(path, follow):
+        references = [[idx for idx in ref if idx != eos] for ref in record['references']]
+        if len(references) == 0 or len(record['nbest']) == 0:
+            continue
+        for line in record['nbest'][:nbest]:
+            metric.add(references, [idx for idx in line['tokens'] if idx != eos])
+        records += 1
+        if report > 0 and records % report == 0:
+            print 'records: %d, bleu: %f' % (records, metric.bleu())
+    return metric.bleu(), metric.count
+
 def draw_confusion_matrix(conf_arr, x_annotations, y_annotations):
     # reference: http://blog.csdn.net/epsil/article/details/9171527
     # x_annotations: source sentence, y_annotations: target_sentence
@@ -74,6 +206,17 @@ def test():
         print f
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'BLEU of a generate records file, or the attention plot demo')
+    parser.add_argument('--records', default = None, type = str, help = 'JSONL records of train.py generate mode')
+    parser.add_argument('--follow', action = 'store_true', help = 'evaluate while the generation is running')
+    parser.add_argument('--eos', default = 1, type = int, help = 'eos word id, removed before the scoring')
+    parser.add_argument('--nbest', default = None, type = int, help = 'n-best lines scored per record, default all (as read_file)')
+    parser.add_argument('--report', default = 100, type = int, help = 'print the running bleu every report records')
+    args = parser.parse_args()
+    if args.records is not None:
+        bleu, count = records_bleu(args.records, eos = args.eos, nbest = args.nbest, follow = args.follow, report = args.report)
+        print 'Test-Blue: %f on %d hypotheses' % (bleu, count)
+        sys.exit(0)
     conf_arr = np.zeros((3,3))
     conf_arr[0,0] = 1
     conf_arr[1,1] = 1
@@ -1,25 +1,81 @@
 #coding=utf-8
 
-import sys, os
-import copy
-import math
+import sys, os, time
 import mxnet as mx
 import numpy as np 
 sys.path.append('..')
 from rnn.rnn import GRU
+from inference import bind_executor
+from beam_search import BeamSearch
+from shortlist import output_layer
+from length_inputs import sequence_mask, shifted_label, training_output
 from enc_dec_iter import EncoderDecoderIter, read_dict, get_enc_dec_text_id
 from eval_and_visual import draw_confusion_matrix
 
+def masked_softmax(scores, enc_mask):
+    '''Softmax of the attention scores over the encoder positions
+        Inputs:
+            scores: (batch, enc_len, 1)
+            enc_mask: (batch, enc_len) or None (inference, no padding)
+        Outputs:
+            attention: (batch, enc_len, 1), zero on the pad positions
+
+        The pad positions get a large negative score before the softmax, which equals
+        to masking and renormalizing the softmax output without the temporaries.
+    '''
+    if enc_mask is not None:
+        penalty = mx.sym.Reshape((enc_mask - 1) * 1e8, shape = (-2, 1))
+        scores = scores + penalty
+    return mx.sym.SoftmaxActivation(data = scores, mode = 'channel')
+
+def local_window(position, enc_len, half_window):
+    '''The [begin, end) encoder positions a decoder position attends to in local attention
+
+    The window has 2 * half_window + 1 positions centered on position (couplets are
+    position-aligned); it is shifted inside the sentence at the borders, so every
+    position of the window is valid and its width is fixed for a given enc_len.
+    '''
+    width = min(2 * half_window + 1, enc_len)
+    begin = min(max(position - half_window, 0), enc_len - width)
+    return begin, begin + width
+
+def local_window_mask(enc_mask, position, enc_len, half_window):
+    '''(training) enc_mask restricted to the local_window of every row, computed in the
+    graph from the real lengths (the sum of enc_mask) as the inference does from the
+    sentence length, instead of the padded enc_len of the bucket
+        Inputs:
+            enc_mask: (batch, enc_len)
+        Outputs:
+            (batch, enc_len) mask, 1 on the window of position in the sentence of the row
+    '''
+    length = mx.sym.sum(enc_mask, axis = 1)
+    width = mx.sym.minimum(length, 2 * half_window + 1)
+    begin = mx.sym.minimum(length - width, max(position - half_window, 0))
+    positions = mx.sym.Reshape(mx.sym.arange(start = 0, stop = enc_len), shape = (1, enc_len))
+    after_begin = mx.sym.broadcast_greater_equal(positions, mx.sym.Reshape(begin, shape = (-1, 1)))
+    before_end = mx.sym.broadcast_lesser(positions, mx.sym.Reshape(begin + width, shape = (-1, 1)))
+    return enc_mask * after_begin * before_end
+
 class GlobalSeq2Seq(object):
     '''Sequence to sequence learning with neural networks
     The basic sequence to sequence learning network
 
     Note: you can't use gru as encoder and lstm as decoder
     because so makes the lstm cell has no initilization. 
+
+    attention_type: dot, concat, general, nolinear, local
+    half_window: (local attention) the decoder position i attends to the encoder
+        positions [i - half_window, i + half_window]
+    length_inputs: train on enc_length / dec_length instead of the masks and the label,
+        see length_inputs.py
+    context_mode: how the context vector is computed from the attention weights
+        batch_dot: batch_dot(attention^T, enc_hidden), no (batch, enc_len, hidden) temporary
+        broadcast: sum(broadcast_mul(enc_hidden, attention), axis = 1)
     '''
 
     def __init__(self, enc_input_size, dec_input_size, enc_len, dec_len, num_label,
-                share_embed_weight = False, is_train = True, ignore_label = 0):
+                share_embed_weight = False, is_train = True, ignore_label = 0, eos = 1, context_mode = 'batch_dot',
+                attention_type = 'nolinear', half_window = 2, length_inputs = False):
         super(GlobalSeq2Seq, self).__init__()
         # ------------------- Parameter definition -------------------------
         ''' The layer is 1, if you want to change it, there are some things to correct '''
@@ -39,6 +95,12 @@ class GlobalSeq2Seq(object):
         self.dec_name = 'dec'
         self.output_dropout = 0.
         self.ignore_label = ignore_label
+        self.eos = eos # appended to the label by shifted_label, the eos of the iterator
+        # train on enc_length / dec_length, the masks and the label are made in the graph
+        self.length_inputs = length_inputs
+        self.context_mode = context_mode
+        self.attention_type = attention_type
+        self.half_window = half_window
 
         if self.share_embed_weight:  # (for same language task, for example, dialog)
             self.embed_weight = mx.sym.Variable('embed_weight')
@@ -50,7 +112,10 @@ class GlobalSeq2Seq(object):
 
     def encoder(self):
         enc_data = mx.sym.Variable('%s_data' % self.enc_name)
-        if self.is_train:
+        if self.is_train and self.length_inputs:
+            enc_length = mx.sym.Variable('%s_length' % self.enc_name)
+            enc_mask = sequence_mask(enc_length, self.enc_len, '%s_mask' % self.enc_name)
+        elif self.is_train:
             enc_mask = mx.sym.Variable('%s_mask' % self.enc_name)
         else:
             enc_mask = None
@@ -95,23 +160,18 @@ class GlobalSeq2Seq(object):
             super(GlobalSeq2Seq.DotAttention, self).__init__()
             self.is_train = is_train
 
-        def __call__(self, enc_hiddens, dec_hidden, enc_len, enc_mask):
+        def project(self, enc_hiddens):
+            '''the encoder side of e, computed once per sequence; nothing to project here'''
+            return enc_hiddens
+
+        def __call__(self, enc_keys, dec_hidden, enc_len, enc_mask):
             target_hidden = mx.sym.Reshape(dec_hidden, shape = (-2, 1))
-            source_target_atten = mx.sym.batch_dot(enc_hiddens, target_hidden)
-            # if want to add mask, add mask here
-            attention = mx.sym.SoftmaxActivation(data = source_target_atten, mode = 'channel')
-            # if want to add mask, add mask here
-            if self.is_train:
-                temp_mask = mx.sym.Reshape(enc_mask, shape=(-2, 1))
-                attention = mx.sym.broadcast_mul(attention, temp_mask)
-                attention_sum = mx.sym.sum(attention, axis=1, keepdims=True)
-                attention_sum = mx.sym.broadcast_axis(attention_sum, axis=1, size=enc_len)
-                attention = mx.sym.broadcast_div(attention, attention_sum)
-            return attention
+            source_target_atten = mx.sym.batch_dot(enc_keys, target_hidden)
+            return masked_softmax(source_target_atten, enc_mask)
 
     class ConcatAttention(object):
         '''Effective Approaches to Attention-based Neural Machine Translation
-            e = W[enc_hiddens; dec_hidden]
+            e = W[enc_hiddens; dec_hidden] = W_enc * enc_hiddens + W_dec * dec_hidden
         '''
         def __init__(self, enc_num_hidden, dec_num_hidden, is_train):
             super(GlobalSeq2Seq.ConcatAttention, self).__init__()
@@ -119,21 +179,20 @@ class GlobalSeq2Seq(object):
             self.enc_num_hidden = enc_num_hidden
             self.dec_num_hidden = dec_num_hidden
             self.weight = mx.sym.Variable('source_target_concat_weight', shape = (2 * self.enc_num_hidden + self.dec_num_hidden, 1))       
-
-        def __call__(self, enc_hiddens, dec_hidden, enc_len, enc_mask):
-            target_hidden = mx.sym.expand_dims(dec_hidden, axis = 1)
-            target_hidden = mx.sym.broadcast_axis(target_hidden, axis = 1, size = enc_len)
-            source_target_hidden = mx.sym.Concat(*[enc_hiddens, target_hidden], dim = 2)
-            source_target_atten = mx.sym.dot(source_target_hidden, self.weight)
-            attention = mx.sym.SoftmaxActivation(data = source_target_atten, mode = 'channel')
-            # if want to add mask, add mask here
-            if self.is_train:
-                temp_mask = mx.sym.Reshape(enc_mask, shape=(-2, 1))
-                attention = mx.sym.broadcast_mul(attention, temp_mask)
-                attention_sum = mx.sym.sum(attention, axis=1, keepdims=True)
-                attention_sum = mx.sym.broadcast_axis(attention_sum, axis=1, size=enc_len)
-                attention = mx.sym.broadcast_div(attention, attention_sum)
-            return attention
+            # the same parameter, split into its encoder and decoder rows
+            self.enc_weight = mx.sym.slice_axis(self.weight, axis = 0, begin = 0, end = 2 * self.enc_num_hidden)
+            self.dec_weight = mx.sym.slice_axis(self.weight, axis = 0, begin = 2 * self.enc_num_hidden, 
+                end = 2 * self.enc_num_hidden + self.dec_num_hidden)
+
+        def project(self, enc_hiddens):
+            '''the encoder side of e, computed once per sequence: (batch, enc_len, 1)'''
+            return mx.sym.dot(enc_hiddens, self.enc_weight)
+
+        def __call__(self, enc_keys, dec_hidden, enc_len, enc_mask):
+            target_hidden = mx.sym.dot(dec_hidden, self.dec_weight)
+            target_hidden = mx.sym.expand_dims(target_hidden, axis = 1)
+            source_target_atten = mx.sym.broadcast_add(enc_keys, target_hidden)
+            return masked_softmax(source_target_atten, enc_mask)
     
     class GeneralAttention(object):
         '''Effective Approaches to Attention-based Neural Machine Translation
@@ -146,19 +205,14 @@ class GlobalSeq2Seq(object):
             self.dec_num_hidden = dec_num_hidden
             self.weight = mx.sym.Variable('source_target_multi_weight', shape = (2 * self.enc_num_hidden, self.dec_num_hidden))       
 
-        def __call__(self, enc_hiddens, dec_hidden, enc_len, enc_mask):
-            hidden = mx.sym.dot(enc_hiddens, self.weight)
+        def project(self, enc_hiddens):
+            '''the encoder side of e, computed once per sequence: (batch, enc_len, dec_num_hidden)'''
+            return mx.sym.dot(enc_hiddens, self.weight)
+
+        def __call__(self, enc_keys, dec_hidden, enc_len, enc_mask):
             target_hidden = mx.sym.Reshape(dec_hidden, shape = (-2, 1))
-            source_target_atten = mx.sym.batch_dot(hidden, target_hidden)
-            attention = mx.sym.SoftmaxActivation(data = source_target_atten, mode = 'channel')
-            # if want to add mask, add mask here
-            if self.is_train:
-                temp_mask = mx.sym.Reshape(enc_mask, shape=(-2, 1))
-                attention = mx.sym.broadcast_mul(attention, temp_mask)
-                attention_sum = mx.sym.sum(attention, axis=1, keepdims=True)
-                attention_sum = mx.sym.broadcast_axis(attention_sum, axis=1, size=enc_len)
-                attention = mx.sym.broadcast_div(attention, attention_sum)
-            return attention
+            source_target_atten = mx.sym.batch_dot(enc_keys, target_hidden)
+            return masked_softmax(source_target_atten, enc_mask)
 
     class NolinearAttention(object):
         '''Neural Machine Translation By Jointly Learning to Align and Translate
@@ -174,39 +228,71 @@ class GlobalSeq2Seq(object):
             self.u_weight = mx.sym.Variable('target_attenion_weight', shape = (self.dec_num_hidden, self.atten_dim))
             self.v_weight = mx.sym.Variable('attention_weight', shape = (self.atten_dim, 1))            
 
-        def __call__(self, enc_hiddens, dec_hidden, enc_len, enc_mask):
+        def project(self, enc_hiddens):
+            '''the encoder side of e, computed once per sequence: (batch, enc_len, atten_dim)'''
+            return mx.sym.dot(enc_hiddens, self.w_weight)
+
+        def __call__(self, enc_keys, dec_hidden, enc_len, enc_mask):
             target_hidden = mx.sym.dot(dec_hidden, self.u_weight)
             target_hidden = mx.sym.expand_dims(target_hidden, axis=1)
-            target_hidden = mx.sym.broadcast_axis(target_hidden, axis = 1, size = enc_len)
-            source_hidden = mx.sym.dot(enc_hiddens, self.w_weight)
-            temp = mx.sym.broadcast_add(target_hidden, source_hidden, name = 'error')
+            temp = mx.sym.broadcast_add(enc_keys, target_hidden, name = 'error')
             source_target_hidden = mx.sym.Activation(temp, act_type="tanh")
             source_target_atten = mx.sym.dot(source_target_hidden, self.v_weight)
-            attention = mx.sym.SoftmaxActivation(data = source_target_atten, mode = 'channel')
-            # if want to add mask, add mask here
-            if self.is_train:
-                temp_mask = mx.sym.Reshape(enc_mask, shape=(-2, 1))
-                attention = mx.sym.broadcast_mul(attention, temp_mask)
-                attention_sum = mx.sym.sum(attention, axis=1, keepdims=True)
-                attention_sum = mx.sym.broadcast_axis(attention_sum, axis=1, size=enc_len)
-                attention = mx.sym.broadcast_div(attention, attention_sum)
-            return attention
+            return masked_softmax(source_target_atten, enc_mask)
+
+    class LocalAttention(object):
+        '''Effective Approaches to Attention-based Neural Machine Translation (local-m)
+            e = v^T * tanh(w * enc_hiddens + u * dec_hidden), on the window of local_window only
+
+            At inference the enc_keys and enc_mask passed to __call__ are the ones of the
+            window, so the cost per step is O(window) instead of O(enc_len). In training the
+            sentences of a bucket have different lengths, so the whole encoder is scored with
+            the window of every sentence as mask (local_window_mask).
+        '''
+        def __init__(self, enc_num_hidden, dec_num_hidden, is_train, half_window = 2):
+            super(GlobalSeq2Seq.LocalAttention, self).__init__()
+            self.is_train = is_train
+            self.half_window = half_window
+            self.score = GlobalSeq2Seq.NolinearAttention(enc_num_hidden, dec_num_hidden, is_train)
+
+        def project(self, enc_hiddens):
+            return self.score.project(enc_hiddens)
+
+        def __call__(self, enc_keys, dec_hidden, enc_len, enc_mask):
+            return self.score(enc_keys, dec_hidden, enc_len, enc_mask)
 
     def get_attention(self):
-        return self.symbol_define(attention_type = 'nolinear', get_attention = True)
+        return self.symbol_define(get_attention = True)
 
     def get_sofxmax(self):
-        return self.symbol_define(attention_type = 'nolinear', get_attention = False)
+        return self.symbol_define(get_attention = False)
 
 
-    def symbol_define(self, attention_type = 'nolinear', get_attention = False):
+    def symbol_define(self, attention_type = None, get_attention = False, beam = 1, shortlist_size = None):
         '''
             Inputs:
-                attention_type: dot, concat, general, nolinear
+                attention_type: dot, concat, general, nolinear, local (default self.attention_type)
                 get_attention: get the variable for attention graph 
+                beam: (inference only) every row of enc_hidden is broadcast to beam decoder rows
         '''
         enc_mask, enc_output, forward_enc_last_h = self.encoder()
 
+        # Attention function selection
+        if attention_type is None:
+            attention_type = self.attention_type
+        if attention_type == 'nolinear':
+            attention_func = GlobalSeq2Seq.NolinearAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
+        elif attention_type == 'concat':
+            attention_func = GlobalSeq2Seq.ConcatAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
+        elif attention_type == 'dot':
+            attention_func = GlobalSeq2Seq.DotAttention(self.is_train)
+        elif attention_type == 'general':
+            attention_func = GlobalSeq2Seq.GeneralAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
+        elif attention_type == 'local':
+            attention_func = GlobalSeq2Seq.LocalAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train, self.half_window)
+        else:
+            raise NameError, 'Attention types: nolinear, concat, dot, general, local'
+
         # Transform encoder last hidden state to decoder init state
         dec_trans_h_temp = mx.sym.FullyConnected(
             data = forward_enc_last_h, 
@@ -218,7 +304,12 @@ class GlobalSeq2Seq(object):
         # decoder input processing        
         dec_data = mx.sym.Variable('%s_data' % self.dec_name)
         if self.is_train:
-            dec_mask = mx.sym.Variable('%s_mask' % self.dec_name)
+            if self.length_inputs:
+                # eos is counted in the decoder mask
+                dec_length = mx.sym.Variable('%s_length' % self.dec_name)
+                dec_mask = sequence_mask(dec_length + 1, self.dec_len, '%s_mask' % self.dec_name)
+            else:
+                dec_mask = mx.sym.Variable('%s_mask' % self.dec_name)
             mask = mx.sym.SliceChannel(
                 data = dec_mask,
                 num_outputs = self.dec_len,
@@ -244,22 +335,22 @@ class GlobalSeq2Seq(object):
         )
         if not self.is_train:
             dec_init_h = mx.sym.Variable('%s_l0_init_h' % self.dec_name) 
+            # enc_hidden and enc_keys are the encoder outputs themselves (for local attention,
+            # their window at the current step, see attention_feed), broadcast to the beam here
             enc_hidden = mx.sym.Variable('enc_hidden')
+            enc_keys = mx.sym.Variable('enc_keys')
+            if beam > 1:
+                enc_hidden = mx.sym.expand_dims(enc_hidden, axis = 1)
+                enc_hidden = mx.sym.broadcast_axis(enc_hidden, axis = 1, size = beam)
+                enc_hidden = mx.sym.Reshape(enc_hidden, shape = (-3, -2))
+                enc_keys = mx.sym.expand_dims(enc_keys, axis = 1)
+                enc_keys = mx.sym.broadcast_axis(enc_keys, axis = 1, size = beam)
+                enc_keys = mx.sym.Reshape(enc_keys, shape = (-3, -2))
         else:
             dec_init_h = dec_trans_h
             enc_hidden = enc_output
-        
-        # Attention function selection
-        if attention_type == 'nolinear':
-            attention_func = GlobalSeq2Seq.NolinearAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
-        elif attention_type == 'concat':
-            attention_func = GlobalSeq2Seq.ConcatAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
-        elif attention_type == 'dot':
-            attention_func = GlobalSeq2Seq.DotAttention(self.is_train)
-        elif attention_type == 'general':
-            attention_func = GlobalSeq2Seq.GeneralAttention(self.enc_num_hidden, self.dec_num_hidden, self.is_train)
-        else:
-            raise NameError, 'Attention types: nolinear, concat, dot, general'
+            # the encoder side of the attention does not depend on the decoder state
+            enc_keys = attention_func.project(enc_hidden)
 
         # decoder
         dec_output = []
@@ -267,10 +358,20 @@ class GlobalSeq2Seq(object):
         states = [dec_init_h]
         gru = GRU(num_hidden = self.dec_num_hidden, name = self.dec_name)
         for i in range(self.dec_len):
-            attention =attention_func(enc_hidden, states[0], self.enc_len, enc_mask)
+            if attention_type == 'local' and self.is_train:
+                # the window of the step i in every sentence, the inference decoder gets it fed
+                step_hidden, step_keys = enc_hidden, enc_keys
+                step_mask = local_window_mask(enc_mask, i, self.enc_len, self.half_window)
+            else:
+                step_hidden, step_keys, step_mask = enc_hidden, enc_keys, enc_mask
+            attention = attention_func(step_keys, states[0], self.enc_len, step_mask)
             attentions_list.append(attention)
-            context_vector_pre = mx.sym.broadcast_mul(enc_hidden, attention)
-            context_vector = mx.sym.sum(context_vector_pre, axis = 1)
+            if self.context_mode == 'batch_dot':
+                context_vector = mx.sym.batch_dot(attention, step_hidden, transpose_a = True)
+                context_vector = mx.sym.Reshape(context_vector, shape = (0, -1))
+            else:
+                context_vector_pre = mx.sym.broadcast_mul(step_hidden, attention)
+                context_vector = mx.sym.sum(context_vector_pre, axis = 1)
             data = mx.sym.Concat(*[embed[i], context_vector], dim= 1)
             if self.is_train:
                 output, states = gru(data, states, mask[i])
@@ -289,12 +390,11 @@ class GlobalSeq2Seq(object):
         dec_output = mx.symbol.Concat(*dec_output, dim=1)
         hidden_concat = mx.sym.Reshape(dec_output, shape=(-1, self.dec_num_hidden))
         #hidden_concat = mx.sym.Dropout(data = hidden_concat, p = self.output_dropout)
-        pred = mx.sym.FullyConnected(
-            data = hidden_concat, 
-            num_hidden = self.num_label,
-            name = '%s_pred' % self.dec_name
-        )
-        label = mx.sym.Variable('label')
+        pred = output_layer(hidden_concat, self.num_label, '%s_pred' % self.dec_name, shortlist_size)
+        if self.is_train and self.length_inputs:
+            label = shifted_label(dec_data, dec_length, self.dec_len, eos = self.eos, pad = self.ignore_label)
+        else:
+            label = mx.sym.Variable('label')
         label = mx.sym.Reshape(data = label, shape = (-1, ))
         if self.is_train:
             sm = mx.sym.SoftmaxOutput(
@@ -304,140 +404,154 @@ class GlobalSeq2Seq(object):
                 use_ignore = True, 
                 ignore_label = self.ignore_label
             )
+            if self.length_inputs:
+                return training_output(sm, label)
             return sm
         else:
             sm = mx.sym.SoftmaxOutput(data = pred, name = 'softmax')      
-            return mx.sym.Group([dec_trans_h, enc_output]), mx.sym.Group([sm, dec_last_h])
+            # BlockGrad makes a distinct output even when project is the identity (dot)
+            enc_keys_output = mx.sym.BlockGrad(attention_func.project(enc_output), name = 'enc_keys')
+            return mx.sym.Group([dec_trans_h, enc_output, enc_keys_output]), mx.sym.Group([sm, dec_last_h])
 
 
-    def predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2):
-        # ------------------------- bind data to symbol ---------------------------
-        encoder, decoder = self.symbol_define()
+    def bind_executors(self, arg_params, beam = 1, batch_size = 1, ctx = mx.cpu(), shared_executors = None, 
+                shortlist_size = None):
+        '''Bind the inference encoder at batch_size sentences and the decoder at batch_size * beam,
+        with shortlist_size the output layer of the decoder only covers its 'shortlist' input words
+            Outputs:
+                (encoder_executor, decoder_executor)
+        '''
+        encoder, decoder = self.symbol_define(beam = beam, shortlist_size = shortlist_size)
+        if shared_executors is None:
+            shared_executors = (None, None)
         input_shapes = {}
-        input_shapes['enc_data'] = (1, self.enc_len)
-        encoder_executor = encoder.simple_bind(ctx = mx.cpu(), **input_shapes)
-        for key in encoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(encoder_executor.arg_dict[key])
+        input_shapes['enc_data'] = (batch_size, self.enc_len)
+        encoder_executor = bind_executor(encoder, input_shapes, arg_params, ctx, shared_executors[0])
+        # the encoder outputs are bound as the enc_hidden / enc_keys of the decoder, they are never copied
+        enc_output = encoder_executor.outputs[1]
+        enc_keys = encoder_executor.outputs[2]
+        dec_init_states = [('%s_l0_init_h' % self.dec_name, (batch_size * beam, self.dec_num_hidden))]
+        dec_data_shape = [("dec_data", (batch_size * beam, 1))]
+        if self.attention_type == 'local':
+            # only the window is bound, it is copied in at every step by attention_feed
+            begin, end = local_window(0, self.enc_len, self.half_window)
+            enc_hidden_shape = [('enc_hidden', (batch_size, end - begin, enc_output.shape[2])), 
+                ('enc_keys', (batch_size, end - begin, enc_keys.shape[2]))]
+            shared_args = {}
+        else:
+            enc_hidden_shape = [('enc_hidden', enc_output.shape), ('enc_keys', enc_keys.shape)]
+            shared_args = {'enc_hidden' : enc_output, 'enc_keys' : enc_keys}
+        dec_input_shapes = dict(dec_data_shape + dec_init_states + enc_hidden_shape)
+        if shortlist_size is not None:
+            dec_input_shapes['shortlist'] = (shortlist_size, )
+        decoder_executor = bind_executor(decoder, dec_input_shapes, arg_params, ctx, shared_executors[1],
+            shared_args = shared_args)
+        return encoder_executor, decoder_executor
+
+    def attention_feed(self, executors):
+        '''The feed function of the beam search: with local attention, copy the window
+        of the encoder outputs at the current step into the decoder, None otherwise
+        '''
+        if self.attention_type != 'local':
+            return None
+        encoder_executor, decoder_executor = executors
+        def feed(seqidx):
+            begin, end = local_window(seqidx, self.enc_len, self.half_window)
+            mx.nd.slice_axis(encoder_executor.outputs[1], axis = 1, begin = begin, end = end).copyto(
+                decoder_executor.arg_dict['enc_hidden'])
+            mx.nd.slice_axis(encoder_executor.outputs[2], axis = 1, begin = begin, end = end).copyto(
+                decoder_executor.arg_dict['enc_keys'])
+        return feed
+
+    def batch_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 10, executors = None,
+                early_stop = False, prune_margin = None, deadline = None):
+        '''Beam search for a batch of sentences with the same length
+            Inputs:
+                enc_data: NDArray with shape (batch_size, enc_len)
+                early_stop, prune_margin: see BeamSearch, the search stats are kept in self.search_stats
+                deadline: latency budget in seconds, when it is hit the hypotheses found so far are
+                    returned and self.search_stats['truncated'] is True
+            Outputs:
+                list of the sorted (score, sent) of every sentence
+        '''
+        end_time = None if deadline is None else time.time() + deadline
+        # ------------------------- bind data to symbol ---------------------------
+        if executors is None:
+            executors = self.bind_executors(arg_params, beam, enc_data.shape[0])
+        encoder_executor, decoder_executor = executors
         enc_data.copyto(encoder_executor.arg_dict['enc_data'])
         encoder_executor.forward()
-        enc_hidden = encoder_executor.outputs[1]
-        dec_init_states = [('%s_l0_init_h' % self.dec_name, (1, self.dec_num_hidden))]
-        state_name = [item[0] for item in dec_init_states]
-        init_states_dict = dict(zip(state_name, [encoder_executor.outputs[0]]))
-        dec_data_shape = [("dec_data", (1,1))]
-        enc_hidden_shape = [('enc_hidden', (1, self.enc_len, self.enc_num_hidden * 2))]
-        dec_input_shapes = dict(dec_data_shape + dec_init_states + enc_hidden_shape)
-        decoder_executor = decoder.simple_bind(ctx = mx.cpu(), **dec_input_shapes)
-        for key in decoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(decoder_executor.arg_dict[key])
+        state_name = ['%s_l0_init_h' % self.dec_name]
         # --------------------------- beam search ---------------------------------
-        beam = 10
-        active_sentences = [(0,[eos], copy.deepcopy(init_states_dict))]
-        ended_sentences = []
-        min_length = 1
-        max_length = 30
-        min_count = min(beam, len(active_sentences))
-        for seqidx in xrange(max_length):
-            tmp_sentences = []
-            for i in xrange(min_count):
-                states_dict  = active_sentences[i][2]
-                for key in states_dict.keys():
-                    states_dict[key].copyto(decoder_executor.arg_dict[key])
-                decoder_executor.arg_dict["dec_data"][:] = active_sentences[i][1][-1]
-                decoder_executor.arg_dict['enc_hidden'][:] = enc_hidden.asnumpy()
-                decoder_executor.forward()
-                new_states_dict = dict(zip(state_name, decoder_executor.outputs[1:]))
-                tmp_states_dict = copy.deepcopy(new_states_dict)
-
-                prob = decoder_executor.outputs[0].asnumpy()
-                # === this order is from small to big =====
-                indecies = np.argsort(prob, axis = 1)[0]
-
-                for j in xrange(beam):
-                    score = active_sentences[i][0] + math.log(prob[0][indecies[-j-1]])
-                    sent = active_sentences[i][1][:]
-                    sent.extend([indecies[-j-1]])
-                    if sent[-1] == eos:
-                        if seqidx >= min_length:
-                            ended_sentences.append((score, sent))
-                    elif sent[-1] != unk and sent[-1] != pad:
-                        tmp_sentences.append((score, sent, tmp_states_dict))
-
-            min_count = min(beam, len(tmp_sentences))
-            active_sentences = sorted(tmp_sentences, reverse = True)[:min_count]
-        result_sentences = []
-        for sent in active_sentences:
-            result_sentences.append((sent[0], sent[1]))
-        for sent in ended_sentences:
-            result_sentences.append(sent)
-        #result = min(beam, len(result_sentences), 10)
-        #result_sentences = sorted(result_sentences, reverse = True)[:result]
-        result_sentences = sorted(result_sentences, reverse = True)        
-        return result_sentences
-
-    def couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2):
+        searcher = BeamSearch(
+            beam = beam, 
+            max_length = 30, 
+            min_length = 1, 
+            pad = pad, 
+            eos = eos, 
+            unk = unk,
+            early_stop = early_stop,
+            prune_margin = prune_margin,
+            deadline = end_time
+        )
+        results = []
+        for active_sentences, ended_sentences in searcher.search(
+                decoder_executor, state_name, [encoder_executor.outputs[0]], self.attention_feed(executors)):
+            result_sentences = active_sentences + ended_sentences
+            #result = min(beam, len(result_sentences), 10)
+            #result_sentences = sorted(result_sentences, reverse = True)[:result]
+            result_sentences = sorted(result_sentences, reverse = True)        
+            results.append(result_sentences)
+        self.search_stats = searcher.stats
+        return results
+
+    def batch_couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 20, executors = None,
+                constraints = None, deadline = None):
+        '''constraints: per position word constraints, see beam_search.punctuation_constraints
+        deadline: latency budget in seconds, see batch_predict; the lines of a truncated search
+            are partial (shorter than the upper line, rescore of train.py drops them), their
+            sentences are counted in self.search_stats['incomplete']
+        '''
+        end_time = None if deadline is None else time.time() + deadline
         # ------------------------- bind data to symbol ---------------------------
-        encoder, decoder = self.symbol_define()
-        input_shapes = {}
-        input_shapes['enc_data'] = (1, self.enc_len)
-        encoder_executor = encoder.simple_bind(ctx = mx.cpu(), **input_shapes)
-        for key in encoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(encoder_executor.arg_dict[key])
+        if executors is None:
+            executors = self.bind_executors(arg_params, beam, enc_data.shape[0])
+        encoder_executor, decoder_executor = executors
         enc_data.copyto(encoder_executor.arg_dict['enc_data'])
         encoder_executor.forward()
-        enc_hidden = encoder_executor.outputs[1]
-        dec_init_states = [('%s_l0_init_h' % self.dec_name, (1, self.dec_num_hidden))]
-        state_name = [item[0] for item in dec_init_states]
-        init_states_dict = dict(zip(state_name, [encoder_executor.outputs[0]]))
-        dec_data_shape = [("dec_data", (1,1))]
-        enc_hidden_shape = [('enc_hidden', (1, self.enc_len, self.enc_num_hidden * 2))]
-        dec_input_shapes = dict(dec_data_shape + dec_init_states + enc_hidden_shape)
-        decoder_executor = decoder.simple_bind(ctx = mx.cpu(), **dec_input_shapes)
-        for key in decoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(decoder_executor.arg_dict[key])
+        state_name = ['%s_l0_init_h' % self.dec_name]
         # --------------------------- beam search ---------------------------------
-        beam = 20
-        active_sentences = [(0,[eos], copy.deepcopy(init_states_dict))]
-        ended_sentences = []
-        min_length = 1
-        max_length = enc_data.shape[1]
-        min_count = min(beam, len(active_sentences))
-        for seqidx in xrange(max_length):
-            tmp_sentences = []
-            for i in xrange(min_count):
-                states_dict  = active_sentences[i][2]
-                for key in states_dict.keys():
-                    states_dict[key].copyto(decoder_executor.arg_dict[key])
-                decoder_executor.arg_dict["dec_data"][:] = active_sentences[i][1][-1]
-                decoder_executor.arg_dict['enc_hidden'][:] = enc_hidden.asnumpy()
-                decoder_executor.forward()
-                new_states_dict = dict(zip(state_name, decoder_executor.outputs[1:]))
-                tmp_states_dict = copy.deepcopy(new_states_dict)
-
-                prob = decoder_executor.outputs[0].asnumpy()
-                # === this order is from small to big =====
-                indecies = np.argsort(prob, axis = 1)[0]
-
-                for j in xrange(beam):
-                    score = active_sentences[i][0] + math.log(prob[0][indecies[-j-1]])
-                    sent = active_sentences[i][1][:]
-                    sent.extend([indecies[-j-1]])
-                    if sent[-1] != eos and sent[-1] != unk and sent[-1] != pad:
-                        tmp_sentences.append((score, sent, tmp_states_dict))
-
-            min_count = min(beam, len(tmp_sentences))
-            active_sentences = sorted(tmp_sentences, reverse = True)[:min_count]
-        result_sentences = []
-        for sent in active_sentences:
-            result_sentences.append((sent[0], sent[1][1:]))
-        #result = min(beam, len(result_sentences), 10)
-        #result_sentences = sorted(result_sentences, reverse = True)[:result]
-        result_sentences = sorted(result_sentences, reverse = True)        
-        return result_sentences
+        searcher = BeamSearch(
+            beam = beam, 
+            max_length = enc_data.shape[1], 
+            min_length = 1, 
+            pad = pad, 
+            eos = eos, 
+            unk = unk,
+            keep_ended = False,
+            deadline = end_time
+        )
+        results = []
+        for active_sentences, _ in searcher.search(
+                decoder_executor, state_name, [encoder_executor.outputs[0]], self.attention_feed(executors), 
+                constraints = constraints):
+            result_sentences = []
+            for sent in active_sentences:
+                result_sentences.append((sent[0], sent[1][1:]))
+            #result = min(beam, len(result_sentences), 10)
+            #result_sentences = sorted(result_sentences, reverse = True)[:result]
+            result_sentences = sorted(result_sentences, reverse = True)        
+            results.append(result_sentences)
+        self.search_stats = searcher.stats
+        return results
+
+    def predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 10, executors = None,
+                early_stop = False, prune_margin = None, deadline = None):
+        return self.batch_predict(enc_data, arg_params, pad, eos, unk, beam, executors, early_stop, prune_margin, deadline)[0]
+
+    def couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 20, executors = None,
+                constraints = None, deadline = None):
+        return self.batch_couplet_predict(enc_data, arg_params, pad, eos, unk, beam, executors, constraints, deadline)[0]
 
 def get_attentions(source, target, epoch):
     task = 'couplet'
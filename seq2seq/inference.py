@@ -0,0 +1,317 @@
+#coding=utf-8
+
+import hashlib
+from collections import OrderedDict
+
+import mxnet as mx
+import numpy as np
+
+from shortlist import forced_words
+
+def bind_executor(symbol, input_shapes, arg_params, ctx = mx.cpu(), shared_exec = None, shared_args = None):
+    '''Bind a symbol for inference
+
+    The parameters found in arg_params are bound directly (no copy when they are
+    already on ctx), the other inputs are allocated with zeros.
+    shared_exec: executor whose memory pool is shared by the new executor
+    shared_args: dict of NDArray bound as the inputs of the same name, e.g. the
+        outputs of another executor, so they are passed without any copy
+    '''
+    if shared_args is None:
+        shared_args = {}
+    # the parameter shapes are given too, some can not be inferred (e.g. gathered by take)
+    shapes = dict((name, arg_params[name].shape) for name in symbol.list_arguments() if name in arg_params)
+    shapes.update(input_shapes)
+    arg_shapes, _, aux_shapes = symbol.infer_shape(**shapes)
+    args = {}
+    for name, shape in zip(symbol.list_arguments(), arg_shapes):
+        if name in shared_args:
+            args[name] = shared_args[name]
+        elif name in arg_params:
+            args[name] = arg_params[name].as_in_context(ctx)
+        else:
+            args[name] = mx.nd.zeros(shape, ctx)
+    aux_states = [mx.nd.zeros(shape, ctx) for shape in aux_shapes]
+    return symbol.bind(
+        ctx = ctx,
+        args = args,
+        grad_req = 'null',
+        aux_states = aux_states,
+        shared_exec = shared_exec
+    )
+
+def length_batches(enc_data, batch_size):
+    '''Group the sentences by length, the same idea as the buckets of EncoderDecoderIter
+        Inputs:
+            enc_data: list of word id lists
+        Outputs:
+            list of index lists, the sentences of a list have the same length
+            and there are at most batch_size of them
+    '''
+    groups = {}
+    for i, sent in enumerate(enc_data):
+        groups.setdefault(len(sent), []).append(i)
+    batches = []
+    for length in sorted(groups.keys()):
+        indices = groups[length]
+        for j in xrange(0, len(indices), batch_size):
+            batches.append(indices[j:j+batch_size])
+    return batches
+
+def padded_size(batch_size):
+    '''The power of two >= batch_size, the batch sizes of the executors with pad_batches'''
+    size = 1
+    while size < batch_size:
+        size *= 2
+    return size
+
+class EncoderCache(object):
+    '''LRU cache of the encoder outputs, keyed by the token id tuple of the source sentence
+
+    An entry holds the encoder outputs of the sentence (one row of every output, e.g. the
+    decoder init state and enc_output) and, optionally, its finished n-best lists by
+    decoding call. The entries are evicted least recently used first to keep the
+    total size under max_bytes.
+
+    Counters: hits / misses (encoder outputs), nbest_hits, evictions
+    '''
+    def __init__(self, max_bytes = 256 << 20):
+        super(EncoderCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.nbest_hits = 0
+        self.evictions = 0
+
+    def lookup(self, tokens):
+        entry = self.entries.pop(tokens, None)
+        if entry is not None:
+            self.entries[tokens] = entry
+        return entry
+
+    def get_encoded(self, tokens):
+        '''list of NDArray with shape (1, ...), the encoder outputs of tokens, or None'''
+        entry = self.lookup(tokens)
+        if entry is None or entry['encoded'] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['encoded']
+
+    def get_nbest(self, tokens, call):
+        entry = self.lookup(tokens)
+        if entry is None or call not in entry['nbest']:
+            return None
+        self.nbest_hits += 1
+        return entry['nbest'][call]
+
+    def put_encoded(self, tokens, encoded):
+        entry = self.lookup(tokens) or {'encoded' : None, 'nbest' : {}, 'bytes' : 0}
+        entry['encoded'] = encoded
+        self.store(tokens, entry)
+
+    def put_nbest(self, tokens, call, results):
+        entry = self.lookup(tokens) or {'encoded' : None, 'nbest' : {}, 'bytes' : 0}
+        entry['nbest'][call] = results
+        self.store(tokens, entry)
+
+    def store(self, tokens, entry):
+        self.bytes -= entry['bytes']
+        entry['bytes'] = 8 * len(tokens)
+        if entry['encoded'] is not None:
+            entry['bytes'] += sum([int(np.prod(output.shape)) * 4 for output in entry['encoded']])
+        for results in entry['nbest'].values():
+            entry['bytes'] += sum([16 + 8 * len(sent) for _, sent in results])
+        self.entries[tokens] = entry
+        self.bytes += entry['bytes']
+        while self.bytes > self.max_bytes and len(self.entries) > 0:
+            _, evicted = self.entries.popitem(last = False)
+            self.bytes -= evicted['bytes']
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'nbest_hits' : self.nbest_hits,
+            'evictions' : self.evictions,
+            'entries' : len(self.entries),
+            'bytes' : self.bytes
+        }
+
+class ReplayEncoder(object):
+    '''Stands for an encoder executor whose outputs were filled from the EncoderCache,
+    so the forward of the models is a no-op'''
+    def __init__(self, executor):
+        super(ReplayEncoder, self).__init__()
+        self.arg_dict = executor.arg_dict
+        self.outputs = executor.outputs
+
+    def forward(self, *args, **kwargs):
+        pass
+
+class InferenceSession(object):
+    '''Persistent inference session for the interactive and generate modes
+
+    The bound encoder/decoder executors are cached by (enc_len, batch_size), so repeated
+    queries skip the graph construction, the binding and the weight copies.
+    The cache is bounded by max_cached and evicts the least recently used entry
+    (binds counts the executors bound). New executors share the memory of the largest
+    executors bound so far.
+
+    With pad_batches, the batches are padded (copies of their last sentence) up to a power
+    of two and the results of the padding are dropped, so batches of any size only need
+    the executors of log2(max batch) sizes per length.
+
+    With cache_bytes > 0, an EncoderCache in front of the encoder skips the encoder
+    for the batches whose sentences were all encoded before, and with cache_nbest
+    the sentences already decoded by the same call skip the decoding too
+    (the calls with a deadline are not cached since they may be truncated).
+
+    With a shortlist (shortlist.Shortlist), the decoders are bound with an output layer
+    over shortlist.size words, the candidates of every batch are computed from its sentences.
+
+    Args:
+        Model: Seq2Seq, GlobalSeq2Seq or FocusSeq2Seq
+        arg_params: the parameters of the checkpoint
+        beam: the beam width the decoder is bound at
+        max_cached: number of (enc_len, batch_size) executors kept, see cache_size
+        model_args: the other arguments of Model, e.g. enc_input_size, num_label
+    '''
+    def __init__(self, Model, arg_params, beam = 10, max_cached = 8, ctx = mx.cpu(),
+                cache_bytes = 0, cache_nbest = False, shortlist = None, pad_batches = False, **model_args):
+        super(InferenceSession, self).__init__()
+        self.Model = Model
+        self.arg_params = dict((key, value.as_in_context(ctx)) for key, value in arg_params.items())
+        self.beam = beam
+        self.max_cached = max_cached
+        self.ctx = ctx
+        self.model_args = model_args
+        self.cache = OrderedDict()
+        self.shared_key = None
+        self.shared_executors = None
+        self.encoder_cache = EncoderCache(cache_bytes) if cache_bytes > 0 else None
+        self.cache_nbest = cache_nbest
+        self.shortlist = shortlist
+        self.pad_batches = pad_batches
+        self.binds = 0
+
+    @staticmethod
+    def cache_size(num_lengths, max_batch = 1, pad_batches = False):
+        '''max_cached holding the executors of num_lengths encoder lengths at all the
+        batch sizes up to max_batch (the powers of two with pad_batches)'''
+        if pad_batches:
+            return num_lengths * (int(np.log2(padded_size(max_batch))) + 1)
+        return num_lengths * max_batch
+
+    def get(self, enc_len, batch_size = 1):
+        '''return (model, (encoder_executor, decoder_executor)) for batch_size sentences of enc_len'''
+        key = (enc_len, batch_size)
+        if key in self.cache:
+            entry = self.cache.pop(key)
+            self.cache[key] = entry
+            return entry
+        model = self.Model(
+            enc_len = enc_len,
+            dec_len = 1,
+            is_train = False,
+            **self.model_args
+        )
+        executors = model.bind_executors(
+            self.arg_params,
+            beam = self.beam,
+            batch_size = batch_size,
+            ctx = self.ctx,
+            shared_executors = self.shared_executors,
+            shortlist_size = None if self.shortlist is None else self.shortlist.size
+        )
+        if self.shared_key is None or enc_len * batch_size > self.shared_key[0] * self.shared_key[1]:
+            self.shared_key = key
+            self.shared_executors = executors
+        self.binds += 1
+        entry = (model, executors)
+        self.cache[key] = entry
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last = False)
+        return entry
+
+    def decode(self, method, enc_data, kwargs):
+        '''Call model.method (batch_predict or batch_couplet_predict) through the EncoderCache'''
+        data = enc_data.asnumpy()
+        if self.encoder_cache is None:
+            return self.run(method, data, kwargs)[0]
+        cache = self.encoder_cache
+        data = data.astype('int64')
+        tokens = [tuple(row) for row in data.tolist()]
+        call = (method, tuple(sorted([(k, v) for k, v in kwargs.items() if k != 'constraints'])))
+        # the n-best lists depend on the constraints of the sentence too
+        calls = [call] * len(tokens)
+        if kwargs.get('constraints') is not None:
+            calls = [call + (hashlib.md5(np.ascontiguousarray(item).tobytes()).hexdigest(), )
+                for item in kwargs['constraints']]
+        use_nbest = self.cache_nbest and kwargs.get('deadline') is None
+        results = [None] * len(tokens)
+        if use_nbest:
+            results = [cache.get_nbest(sent, sent_call) for sent, sent_call in zip(tokens, calls)]
+        todo = [i for i, result in enumerate(results) if result is None]
+        if len(todo) == 0:
+            return results
+        if len(todo) < len(tokens):
+            data = data[todo]
+            if kwargs.get('constraints') is not None:
+                kwargs = dict(kwargs, constraints = kwargs['constraints'][todo])
+        encoded = [cache.get_encoded(tokens[i]) for i in todo]
+        replay = all([item is not None for item in encoded])
+        decoded, encoder_executor = self.run(method, data, kwargs, encoded if replay else None)
+        for j, i in enumerate(todo):
+            if not replay:
+                cache.put_encoded(tokens[i], [output[j:j+1].copy() for output in encoder_executor.outputs])
+            if use_nbest:
+                cache.put_nbest(tokens[i], calls[i], decoded[j])
+            results[i] = decoded[j]
+        return results
+
+    def run(self, method, data, kwargs, encoded = None):
+        '''model.method on the sentences of data (numpy), padded up to a power of two with pad_batches
+            Inputs:
+                encoded: the cached encoder outputs of the sentences (the encoder is skipped) or None
+            Outputs:
+                (the results of the sentences, the encoder executor)
+        '''
+        num = data.shape[0]
+        size = padded_size(num) if self.pad_batches else num
+        if size > num:
+            rows = range(num) + [num - 1] * (size - num)
+            data = data[rows]
+            if kwargs.get('constraints') is not None:
+                kwargs = dict(kwargs, constraints = kwargs['constraints'][rows])
+            if encoded is not None:
+                encoded = [encoded[i] for i in rows]
+        model, executors = self.get(data.shape[1], size)
+        self.set_shortlist(executors, data, kwargs.get('constraints'))
+        encoder_executor = executors[0]
+        if encoded is not None:
+            for k, output in enumerate(encoder_executor.outputs):
+                mx.nd.concatenate([item[k] for item in encoded]).copyto(output)
+            executors = (ReplayEncoder(encoder_executor), executors[1])
+        results = getattr(model, method)(mx.nd.array(data), self.arg_params, beam = self.beam, executors = executors, **kwargs)
+        return results[:num], encoder_executor
+
+    def set_shortlist(self, executors, data, constraints = None):
+        if self.shortlist is not None:
+            required = None if constraints is None else forced_words(constraints)
+            executors[1].arg_dict['shortlist'][:] = self.shortlist.candidates(data, required)
+
+    def predict(self, enc_data, **kwargs):
+        return self.decode('batch_predict', enc_data, kwargs)[0]
+
+    def couplet_predict(self, enc_data, **kwargs):
+        return self.decode('batch_couplet_predict', enc_data, kwargs)[0]
+
+    def batch_predict(self, enc_data, **kwargs):
+        return self.decode('batch_predict', enc_data, kwargs)
+
+    def batch_couplet_predict(self, enc_data, **kwargs):
+        return self.decode('batch_couplet_predict', enc_data, kwargs)
@@ -0,0 +1,44 @@
+#coding=utf-8
+
+import mxnet as mx
+
+# ---- training inputs of the models with length_inputs ----
+# enc_data, enc_length, dec_data, dec_length instead of enc_data, enc_mask, dec_data,
+# dec_mask and label (EncoderDecoderIter(length_inputs = True)): the masks and the label
+# are computed in the graph, only the word ids and the lengths are copied per batch.
+
+def sequence_mask(length, seq_len, name):
+    '''The mask of the first length[i] positions of every row
+        Inputs:
+            length: symbol with shape (batch_size, )
+            seq_len: number of positions
+        Outputs:
+            symbol with shape (batch_size, seq_len), 1 on the positions < length[i]
+    '''
+    positions = mx.sym.Reshape(mx.sym.arange(start = 0, stop = seq_len), shape = (1, seq_len))
+    return mx.sym.broadcast_lesser(positions, mx.sym.Reshape(length, shape = (-1, 1)), name = name)
+
+def shifted_label(dec_data, dec_length, dec_len, eos = 1, pad = 0):
+    '''The label of the decoder input
+        Inputs:
+            dec_data: symbol with shape (batch_size, dec_len), eos, w1 ... wn then pad
+            dec_length: symbol with shape (batch_size, ), the number of words n
+        Outputs:
+            symbol with shape (batch_size, dec_len), w1 ... wn, eos then pad
+    '''
+    if dec_len > 1:
+        words = mx.sym.slice_axis(dec_data, axis = 1, begin = 1, end = dec_len)
+        last = mx.sym.slice_axis(dec_data, axis = 1, begin = 0, end = 1) * 0 + pad
+        next_words = mx.sym.Concat(*[words, last], dim = 1)
+    else:
+        next_words = dec_data * 0 + pad
+    positions = mx.sym.Reshape(mx.sym.arange(start = 0, stop = dec_len), shape = (1, dec_len))
+    is_end = mx.sym.broadcast_equal(positions, mx.sym.Reshape(dec_length, shape = (-1, 1)))
+    return next_words * (1 - is_end) + is_end * eos
+
+def training_output(softmax, label):
+    '''The training symbol of the models with length_inputs
+        Outputs:
+            Group of the softmax and of the label (BlockGrad), PerplexityWithoutExp reads the label there
+    '''
+    return mx.sym.Group([softmax, mx.sym.BlockGrad(label, name = 'label_output')])
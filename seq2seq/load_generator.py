@@ -0,0 +1,70 @@
+#-*- coding:utf-8 -*-
+'''Local load generator for server.py
+
+Sends the sentences of a file (one per line, words separated by spaces; for the
+"post\t=>\tcmnt" test files only the post is used) to the HTTP server from
+concurrent clients and reports the throughput and the latency percentiles.
+
+Example:
+    python load_generator.py --file ../data/couplet/data/final/test.txt --clients 32 --requests 1000
+'''
+
+import sys, argparse, json, time, threading, codecs
+import urllib2
+
+import numpy as np
+
+def read_sentences(path):
+    sentences = []
+    with codecs.open(path, 'r', encoding = 'utf-8', errors = 'ignore') as f:
+        for line in f:
+            line = line.split('\t=>\t')[0].strip()
+            if len(line) > 0:
+                sentences.append(line)
+    return sentences
+
+def client(url, sentences, latencies, batch_sizes, errors, lock):
+    for text in sentences:
+        body = json.dumps({'text' : text}, ensure_ascii = False).encode('utf-8')
+        start = time.time()
+        try:
+            response = json.loads(urllib2.urlopen(urllib2.Request(url, body)).read())
+        except (urllib2.URLError, ValueError):
+            with lock:
+                errors.append(text)
+            continue
+        with lock:
+            latencies.append(time.time() - start)
+            batch_sizes.append(response.get('batch_size', 0))
+            if 'error' in response:
+                errors.append(text)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load generator of the inference server')
+    parser.add_argument('--file', required = True, type = str, help = 'sentences to send')
+    parser.add_argument('--url', default = 'http://127.0.0.1:8080/predict', type = str)
+    parser.add_argument('--clients', default = 16, type = int, help = 'concurrent clients')
+    parser.add_argument('--requests', default = 500, type = int, help = 'total requests')
+    args = parser.parse_args()
+
+    sentences = read_sentences(args.file)
+    sentences = [sentences[i % len(sentences)] for i in xrange(args.requests)]
+    latencies, batch_sizes, errors = [], [], []
+    lock = threading.Lock()
+    threads = [threading.Thread(target = client,
+        args = (args.url, sentences[i::args.clients], latencies, batch_sizes, errors, lock))
+        for i in xrange(args.clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print 'requests: %d, errors: %d, clients: %d' % (len(latencies), len(errors), args.clients)
+    print 'throughput: %.2f sentences/s' % (len(latencies) / elapsed)
+    if len(latencies) > 0:
+        latencies = np.array(latencies) * 1000
+        print 'latency ms: mean %.1f, p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % (latencies.mean(),
+            np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max())
+        print 'mean batch size: %.2f' % np.mean(batch_sizes)
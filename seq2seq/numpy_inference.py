@@ -0,0 +1,315 @@
+#-*- coding:utf-8 -*-
+'''Pure numpy inference of Seq2Seq and GlobalSeq2Seq
+
+The encoder, decoder and attention are computed directly from the checkpoint
+arg_params, with the same parameter names as the symbols (enc_i2h_weight,
+dec_h2h_weight, attention_weight, dec_pred_weight ...), so no symbol is bound.
+For batch 1 step-by-step decoding this avoids the per-call overhead of the executors.
+The beam search is the same BeamSearch, on a NumpyDecoder instead of an executor.
+
+Check against the executors and latency benchmark:
+    python numpy_inference.py --task couplet --model global --data-dir ../data/couplet/data/final \
+        --enc-vocab alllist.txt --dec-vocab alllist.txt --share-embed \
+        --params ../data/couplet/global_params/couplet --epoch 6 --test-file test.txt
+'''
+
+import os, argparse, time
+
+import mxnet as mx
+import numpy as np
+
+from beam_search import BeamSearch
+from global_attention import local_window
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def softmax(x, axis = -1):
+    e = np.exp(x - x.max(axis = axis, keepdims = True))
+    return e / e.sum(axis = axis, keepdims = True)
+
+def fully_connected(data, params, name):
+    '''same as mx.sym.FullyConnected: data * weight^T + bias'''
+    return np.dot(data, params['%s_weight' % name].T) + params['%s_bias' % name]
+
+def gru_step(data, prev_h, params, name):
+    '''One step of rnn.GRU with the parameters of name'''
+    i2h = fully_connected(data, params, '%s_i2h' % name)
+    h2h = fully_connected(prev_h, params, '%s_h2h' % name)
+    i2h_z, i2h_r, i2h = np.split(i2h, 3, axis = 1)
+    h2h_z, h2h_r, h2h = np.split(h2h, 3, axis = 1)
+    update_gate = sigmoid(i2h_z + h2h_z)
+    reset_gate = sigmoid(i2h_r + h2h_r)
+    next_h_tmp = np.tanh(i2h + reset_gate * h2h)
+    return (1. - update_gate) * next_h_tmp + update_gate * prev_h
+
+def gru_unroll(data, params, name, num_hidden, forward = True):
+    '''data: (batch_size, seq_len, num_embed), zero begin state as GRU.unroll
+        Outputs:
+            outputs: (batch_size, seq_len, num_hidden), last_h: (batch_size, num_hidden)
+    '''
+    batch_size, seq_len = data.shape[:2]
+    h = np.zeros((batch_size, num_hidden), dtype = data.dtype)
+    outputs = np.zeros((batch_size, seq_len, num_hidden), dtype = data.dtype)
+    steps = xrange(seq_len) if forward else xrange(seq_len - 1, -1, -1)
+    for k in steps:
+        h = gru_step(data[:, k], h, params, name)
+        outputs[:, k] = h
+    return outputs, h
+
+class NumpyDecoder(object):
+    '''One-step decoder with the interface BeamSearch expects of a decoder executor
+
+    arg_dict holds 'dec_data' and the state, outputs are [softmax, new state], all numpy.
+    With attention, enc_output / enc_keys are repeated to the beam rows once.
+    '''
+    def __init__(self, model, num_rows, enc_output = None, enc_keys = None, beam = 1):
+        super(NumpyDecoder, self).__init__()
+        self.model = model
+        self.state_name = '%s_l0_init_h' % model.dec_name
+        self.arg_dict = {
+            'dec_data' : np.zeros((num_rows, 1), dtype = 'float32'),
+            self.state_name : np.zeros((num_rows, model.dec_num_hidden), dtype = 'float32')
+        }
+        self.outputs = [None, np.zeros((num_rows, model.dec_num_hidden), dtype = 'float32')]
+        self.enc_output = None
+        self.enc_keys = None
+        if enc_output is not None:
+            self.enc_output = np.repeat(enc_output, beam, axis = 0)
+            self.enc_keys = np.repeat(enc_keys, beam, axis = 0)
+        self.seqidx = 0
+
+    def set_step(self, seqidx):
+        '''the feed of BeamSearch, the position of the local attention'''
+        self.seqidx = seqidx
+
+    def forward(self):
+        model = self.model
+        tokens = self.arg_dict['dec_data'][:, 0].astype('int64')
+        prev_h = self.arg_dict[self.state_name]
+        data = model.dec_embed_weight[tokens]
+        if self.enc_output is not None:
+            data = np.concatenate([data, model.context(self.enc_output, self.enc_keys, prev_h, self.seqidx)], axis = 1)
+        next_h = gru_step(data, prev_h, model.params, model.dec_name)
+        self.outputs[0] = softmax(fully_connected(next_h, model.params, '%s_pred' % model.dec_name))
+        self.outputs[1][:] = next_h
+
+class NumpySeq2Seq(object):
+    '''Seq2Seq inference in numpy, the predict methods search as the ones of Seq2Seq
+
+    Args:
+        arg_params: the parameters of the checkpoint (NDArray or numpy)
+    '''
+    # min_length of predict
+    min_length = 0
+
+    def __init__(self, arg_params):
+        super(NumpySeq2Seq, self).__init__()
+        self.params = dict((name, value.asnumpy() if hasattr(value, 'asnumpy') else np.asarray(value))
+            for name, value in arg_params.items())
+        self.enc_name = 'enc'
+        self.dec_name = 'dec'
+        if 'embed_weight' in self.params:
+            self.enc_embed_weight = self.params['embed_weight']
+            self.dec_embed_weight = self.params['embed_weight']
+        else:
+            self.enc_embed_weight = self.params['%s_embed_weight' % self.enc_name]
+            self.dec_embed_weight = self.params['%s_embed_weight' % self.dec_name]
+        self.dec_num_hidden = self.params['%s_h2h_weight' % self.dec_name].shape[1]
+
+    def embed(self, enc_data):
+        return self.enc_embed_weight[np.asarray(enc_data, dtype = 'int64')]
+
+    def init_state(self, enc_last_h):
+        return np.tanh(fully_connected(enc_last_h, self.params, 'encode_to_decode_transform_weight'))
+
+    def encode(self, enc_data):
+        '''enc_data: (batch_size, enc_len) word ids; Outputs: the decoder init state'''
+        num_hidden = self.params['%s_h2h_weight' % self.enc_name].shape[1]
+        _, enc_last_h = gru_unroll(self.embed(enc_data), self.params, self.enc_name, num_hidden)
+        return self.init_state(enc_last_h)
+
+    def decoder(self, enc_data, beam):
+        '''Outputs: (NumpyDecoder at batch_size * beam rows, init state)'''
+        init_h = self.encode(enc_data)
+        return NumpyDecoder(self, init_h.shape[0] * beam), init_h
+
+    def search(self, enc_data, beam, max_length, min_length = 0, keep_ended = True, constraints = None, 
+                deadline = None, **kwargs):
+        end_time = None if deadline is None else time.time() + deadline
+        decoder, init_h = self.decoder(np.asarray(enc_data), beam)
+        searcher = BeamSearch(
+            beam = beam,
+            max_length = max_length,
+            min_length = min_length,
+            keep_ended = keep_ended,
+            deadline = end_time,
+            **kwargs
+        )
+        results = searcher.search(decoder, [decoder.state_name], [init_h], decoder.set_step, constraints = constraints)
+        self.search_stats = searcher.stats
+        return results
+
+    def batch_predict(self, enc_data, pad = 0, eos = 1, unk = 2, beam = 10, 
+                early_stop = False, prune_margin = None, deadline = None):
+        '''enc_data: (batch_size, enc_len) word ids, see Seq2Seq.batch_predict'''
+        results = []
+        for active_sentences, ended_sentences in self.search(enc_data, beam, 30, self.min_length, 
+                pad = pad, eos = eos, unk = unk, early_stop = early_stop, prune_margin = prune_margin, deadline = deadline):
+            results.append(sorted(active_sentences + ended_sentences, reverse = True))
+        return results
+
+    def batch_couplet_predict(self, enc_data, pad = 0, eos = 1, unk = 2, beam = 20, constraints = None, deadline = None):
+        '''enc_data: (batch_size, enc_len) word ids, see Seq2Seq.batch_couplet_predict'''
+        results = []
+        for active_sentences, _ in self.search(enc_data, beam, np.shape(enc_data)[1], keep_ended = False, 
+                constraints = constraints, pad = pad, eos = eos, unk = unk, deadline = deadline):
+            results.append(sorted([(score, sent[1:]) for score, sent in active_sentences], reverse = True))
+        return results
+
+    def predict(self, enc_data, pad = 0, eos = 1, unk = 2, beam = 10, early_stop = False, prune_margin = None, deadline = None):
+        return self.batch_predict(enc_data, pad, eos, unk, beam, early_stop, prune_margin, deadline)[0]
+
+    def couplet_predict(self, enc_data, pad = 0, eos = 1, unk = 2, beam = 20, constraints = None, deadline = None):
+        return self.batch_couplet_predict(enc_data, pad, eos, unk, beam, constraints, deadline)[0]
+
+class NumpyGlobalSeq2Seq(NumpySeq2Seq):
+    '''GlobalSeq2Seq inference in numpy
+
+    Args:
+        attention_type, half_window: as GlobalSeq2Seq
+        bidirectional: as GlobalSeq2Seq.bidirectional
+    '''
+    min_length = 1
+
+    def __init__(self, arg_params, attention_type = 'nolinear', half_window = 2, bidirectional = False):
+        super(NumpyGlobalSeq2Seq, self).__init__(arg_params)
+        self.attention_type = attention_type
+        self.half_window = half_window
+        self.bidirectional = bidirectional
+
+    def encode(self, enc_data):
+        '''Outputs: the decoder init state, enc_output and enc_keys (the projected enc_output)'''
+        embed = self.embed(enc_data)
+        num_hidden = self.params['%s_forward_h2h_weight' % self.enc_name].shape[1]
+        enc_output, forward_last_h = gru_unroll(embed, self.params, '%s_forward' % self.enc_name, num_hidden)
+        if self.bidirectional:
+            backward_output, _ = gru_unroll(embed, self.params, '%s_backward' % self.enc_name, num_hidden, forward = False)
+            enc_output = np.concatenate([enc_output, backward_output], axis = 2)
+        return self.init_state(forward_last_h), enc_output, self.project(enc_output)
+
+    def project(self, enc_output):
+        '''The encoder side of the attention scores, as the project of the attention classes'''
+        if self.attention_type in ['nolinear', 'local']:
+            return np.dot(enc_output, self.params['source_attenion_weight'])
+        elif self.attention_type == 'general':
+            return np.dot(enc_output, self.params['source_target_multi_weight'])
+        elif self.attention_type == 'concat':
+            weight = self.params['source_target_concat_weight']
+            return np.dot(enc_output, weight[:weight.shape[0] - self.dec_num_hidden])
+        return enc_output
+
+    def context(self, enc_output, enc_keys, dec_hidden, seqidx):
+        '''The context vector (num_rows, num_features) of the decoder states dec_hidden'''
+        if self.attention_type == 'local':
+            begin, end = local_window(seqidx, enc_output.shape[1], self.half_window)
+            enc_output = enc_output[:, begin:end]
+            enc_keys = enc_keys[:, begin:end]
+        if self.attention_type in ['nolinear', 'local']:
+            target_hidden = np.dot(dec_hidden, self.params['target_attenion_weight'])
+            hidden = np.tanh(enc_keys + target_hidden[:, np.newaxis, :])
+            scores = np.dot(hidden, self.params['attention_weight'])[:, :, 0]
+        elif self.attention_type == 'concat':
+            weight = self.params['source_target_concat_weight']
+            scores = enc_keys[:, :, 0] + np.dot(dec_hidden, weight[weight.shape[0] - self.dec_num_hidden:])
+        else:
+            scores = np.einsum('rlh,rh->rl', enc_keys, dec_hidden)
+        attention = softmax(scores, axis = 1)
+        return np.einsum('rl,rlh->rh', attention, enc_output)
+
+    def decoder(self, enc_data, beam):
+        init_h, enc_output, enc_keys = self.encode(enc_data)
+        return NumpyDecoder(self, init_h.shape[0] * beam, enc_output, enc_keys, beam), init_h
+
+def check(model, executors, numpy_model, enc_data, eos = 1):
+    '''Max absolute differences of the decoder init state and the first step softmax
+    between the executors (bound at beam 1) and numpy_model, for enc_data (1, enc_len)'''
+    encoder_executor, decoder_executor = executors
+    mx.nd.array(enc_data).copyto(encoder_executor.arg_dict['enc_data'])
+    encoder_executor.forward()
+    init_h = encoder_executor.outputs[0]
+    init_h.copyto(decoder_executor.arg_dict['%s_l0_init_h' % model.dec_name])
+    decoder_executor.arg_dict['dec_data'][:] = eos
+    if hasattr(model, 'attention_feed') and model.attention_feed(executors) is not None:
+        model.attention_feed(executors)(0)
+    decoder_executor.forward()
+
+    decoder, numpy_init_h = numpy_model.decoder(enc_data, 1)
+    decoder.arg_dict[decoder.state_name][:] = numpy_init_h
+    decoder.arg_dict['dec_data'][:] = eos
+    decoder.forward()
+    return (np.abs(init_h.asnumpy() - numpy_init_h).max(), 
+        np.abs(decoder_executor.outputs[0].asnumpy() - decoder.outputs[0]).max())
+
+if __name__ == '__main__':
+    from inference import InferenceSession
+    from beam_search import punctuation_constraints
+    from server import add_model_arguments, load_model
+    from benchmark import read_test_file
+
+    parser = argparse.ArgumentParser(description = 'Check and benchmark the numpy inference against the executors')
+    add_model_arguments(parser)
+    parser.add_argument('--test-file', default = 'test.txt', type = str, help = 'post\\t=>\\tcmnt file in data-dir')
+    parser.add_argument('--num', default = 100, type = int, help = 'number of test posts')
+    args = parser.parse_args()
+
+    Model, enc_word2idx, dec_word2idx, arg_params, model_args = load_model(args)
+    if args.model == 'seq2seq':
+        numpy_model = NumpySeq2Seq(arg_params)
+    elif args.model in ['global', 'local']:
+        numpy_model = NumpyGlobalSeq2Seq(arg_params, attention_type = 'local' if args.model == 'local' else 'nolinear')
+    else:
+        raise NameError, 'numpy inference models: seq2seq, global, local'
+    posts = read_test_file(os.path.join(args.data_dir, args.test_file), enc_word2idx, args.num)
+    punctuation = [(enc_word2idx[w], dec_word2idx[w]) for w in [u'，', u'。']
+        if w in enc_word2idx and w in dec_word2idx]
+    beam = 20 if args.task == 'couplet' else 10
+    # all the executors stay bound, none is bound inside the timing
+    session = InferenceSession(Model, arg_params, beam = beam, 
+        max_cached = InferenceSession.cache_size(len(set([len(data) for data, _ in posts]))), **model_args)
+
+    # ----------------------- numerical check ---------------------------
+    state_diff, prob_diff = 0., 0.
+    for data, _ in posts:
+        enc_data = np.array(data).reshape(1, -1)
+        model = Model(enc_len = enc_data.shape[1], dec_len = 1, is_train = False, **model_args)
+        executors = model.bind_executors(arg_params, beam = 1)
+        diffs = check(model, executors, numpy_model, enc_data)
+        state_diff = max(state_diff, diffs[0])
+        prob_diff = max(prob_diff, diffs[1])
+    print 'max abs diff: init state %g, first step softmax %g' % (state_diff, prob_diff)
+
+    # ----------------------- beam search latency -----------------------
+    for data, _ in posts:
+        session.get(len(data))
+    same = 0
+    executor_time, numpy_time = 0., 0.
+    for data, _ in posts:
+        enc_data = np.array(data).reshape(1, -1)
+        start = time.time()
+        if args.task == 'couplet':
+            constraints = punctuation_constraints(enc_data, punctuation, len(dec_word2idx))
+            executor_results = session.couplet_predict(mx.nd.array(enc_data), constraints = constraints)
+            executor_time += time.time() - start
+            start = time.time()
+            numpy_results = numpy_model.couplet_predict(enc_data, beam = beam, constraints = constraints)
+        else:
+            executor_results = session.predict(mx.nd.array(enc_data))
+            executor_time += time.time() - start
+            start = time.time()
+            numpy_results = numpy_model.predict(enc_data, beam = beam)
+        numpy_time += time.time() - start
+        if len(executor_results) > 0 and len(numpy_results) > 0 and executor_results[0][1] == numpy_results[0][1]:
+            same += 1
+    print 'same best hypothesis: %d / %d' % (same, len(posts))
+    print 'mean latency ms: executor %.2f, numpy %.2f' % (executor_time * 1000 / len(posts), numpy_time * 1000 / len(posts))
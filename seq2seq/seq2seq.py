@@ -1,12 +1,14 @@
 #coding=utf-8
 
-import sys
-import copy
-import math
+import sys, time
 import mxnet as mx
 import numpy as np 
 sys.path.append('..')
 from rnn.rnn import GRU
+from beam_search import BeamSearch
+from shortlist import output_layer
+from length_inputs import sequence_mask, shifted_label, training_output
+from inference import bind_executor
 class Seq2Seq(object):
     '''Sequence to sequence learning with neural networks
     The basic sequence to sequence learning network
@@ -16,7 +18,7 @@ class Seq2Seq(object):
     '''
 
     def __init__(self, enc_input_size, dec_input_size, enc_len, dec_len, num_label,
-                share_embed_weight = False, is_train = True, ignore_label = 0):
+                share_embed_weight = False, is_train = True, ignore_label = 0, eos = 1, length_inputs = False):
         super(Seq2Seq, self).__init__()
         # ------------------- Parameter definition -------------------------
         self.enc_input_size = enc_input_size
@@ -34,6 +36,9 @@ class Seq2Seq(object):
         self.dec_name = 'dec'
         self.output_dropout = 0.
         self.ignore_label = ignore_label
+        self.eos = eos # appended to the label by shifted_label, the eos of the iterator
+        # train on enc_length / dec_length, the masks and the label are made in the graph
+        self.length_inputs = length_inputs
 
         if self.share_embed_weight:  # (for same language task, for example, dialog)
             self.embed_weight = mx.sym.Variable('embed_weight')
@@ -43,9 +48,12 @@ class Seq2Seq(object):
             self.enc_embed_weight = mx.sym.Variable('%s_embed_weight' % self.enc_name)
             self.dec_embed_weight = mx.sym.Variable('%s_embed_weight' % self.dec_name)
 
-    def symbol_define(self):
+    def symbol_define(self, shortlist_size = None):
         enc_data = mx.sym.Variable('%s_data' % self.enc_name)
-        if self.is_train:
+        if self.is_train and self.length_inputs:
+            enc_length = mx.sym.Variable('%s_length' % self.enc_name)
+            enc_mask = sequence_mask(enc_length, self.enc_len, '%s_mask' % self.enc_name)
+        elif self.is_train:
             enc_mask = mx.sym.Variable('%s_mask' % self.enc_name)
         else:
             enc_mask = None
@@ -66,7 +74,11 @@ class Seq2Seq(object):
         )
         dec_trans_h = mx.sym.Activation(dec_trans_h_temp, act_type = "tanh")
         dec_data = mx.sym.Variable('%s_data' % self.dec_name)
-        if self.is_train:
+        if self.is_train and self.length_inputs:
+            # eos is counted in the decoder mask
+            dec_length = mx.sym.Variable('%s_length' % self.dec_name)
+            dec_mask = sequence_mask(dec_length + 1, self.dec_len, '%s_mask' % self.dec_name)
+        elif self.is_train:
             dec_mask = mx.sym.Variable('%s_mask' % self.dec_name)
         else:
             dec_mask = None
@@ -91,12 +103,11 @@ class Seq2Seq(object):
         )
         hidden_concat = mx.sym.Reshape(dec_output, shape=(-1, self.dec_num_hidden))
         #hidden_concat = mx.sym.Dropout(data = hidden_concat, p = self.output_dropout)
-        pred = mx.sym.FullyConnected(
-            data = hidden_concat, 
-            num_hidden = self.num_label,
-            name = '%s_pred' % self.dec_name
-        )
-        label = mx.sym.Variable('label')
+        pred = output_layer(hidden_concat, self.num_label, '%s_pred' % self.dec_name, shortlist_size)
+        if self.is_train and self.length_inputs:
+            label = shifted_label(dec_data, dec_length, self.dec_len, eos = self.eos, pad = self.ignore_label)
+        else:
+            label = mx.sym.Variable('label')
         label = mx.sym.Reshape(data = label, shape = (-1, ))
 
         if self.is_train:
@@ -107,133 +118,122 @@ class Seq2Seq(object):
                 use_ignore = True, 
                 ignore_label = self.ignore_label
             )
+            if self.length_inputs:
+                return training_output(sm, label)
             return sm
         else:
             sm = mx.sym.SoftmaxOutput(data = pred, name = 'softmax')      
             return dec_trans_h, mx.sym.Group([sm, dec_last_h])
 
 
-    def predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2):
-        # ------------------------- bind data to symbol ---------------------------
-        encoder, decoder = self.symbol_define()
+    def bind_executors(self, arg_params, beam = 1, batch_size = 1, ctx = mx.cpu(), shared_executors = None, 
+                shortlist_size = None):
+        '''Bind the inference encoder at batch_size sentences and the decoder at batch_size * beam,
+        with shortlist_size the output layer of the decoder only covers its 'shortlist' input words
+            Outputs:
+                (encoder_executor, decoder_executor)
+        '''
+        encoder, decoder = self.symbol_define(shortlist_size = shortlist_size)
+        if shared_executors is None:
+            shared_executors = (None, None)
         input_shapes = {}
-        input_shapes['enc_data'] = (1, self.enc_len)
-        encoder_executor = encoder.simple_bind(ctx = mx.cpu(), **input_shapes)
-        for key in encoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(encoder_executor.arg_dict[key])
+        input_shapes['enc_data'] = (batch_size, self.enc_len)
+        encoder_executor = bind_executor(encoder, input_shapes, arg_params, ctx, shared_executors[0])
+        dec_init_states = [('%s_l0_init_h' % self.dec_name, (batch_size * beam, self.dec_num_hidden))]
+        dec_data_shape = [("dec_data", (batch_size * beam, 1))]
+        dec_input_shapes = dict(dec_data_shape + dec_init_states)
+        if shortlist_size is not None:
+            dec_input_shapes['shortlist'] = (shortlist_size, )
+        decoder_executor = bind_executor(decoder, dec_input_shapes, arg_params, ctx, shared_executors[1])
+        return encoder_executor, decoder_executor
+
+    def batch_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 10, executors = None,
+                early_stop = False, prune_margin = None, deadline = None):
+        '''Beam search for a batch of sentences with the same length
+            Inputs:
+                enc_data: NDArray with shape (batch_size, enc_len)
+                early_stop, prune_margin: see BeamSearch, the search stats are kept in self.search_stats
+                deadline: latency budget in seconds, when it is hit the hypotheses found so far are
+                    returned and self.search_stats['truncated'] is True
+            Outputs:
+                list of the sorted (score, sent) of every sentence
+        '''
+        end_time = None if deadline is None else time.time() + deadline
+        # ------------------------- bind data to symbol ---------------------------
+        if executors is None:
+            executors = self.bind_executors(arg_params, beam, enc_data.shape[0])
+        encoder_executor, decoder_executor = executors
         enc_data.copyto(encoder_executor.arg_dict['enc_data'])
         encoder_executor.forward()
-        dec_init_states = [('%s_l0_init_h' % self.dec_name, (1, self.dec_num_hidden))]
-        state_name = [item[0] for item in dec_init_states]
-        init_states_dict = dict(zip(state_name, encoder_executor.outputs[:]))
-        dec_data_shape = [("dec_data", (1,1))]
-        dec_input_shapes = dict(dec_data_shape + dec_init_states) 
-        decoder_executor = decoder.simple_bind(ctx = mx.cpu(), **dec_input_shapes)
-        for key in decoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(decoder_executor.arg_dict[key])
-        
-        # --------------------------- beam search ---------------------------------
-        dec_data = mx.nd.zeros((1,1))
-        beam = 10
-        active_sentences = [(0,[eos], copy.deepcopy(init_states_dict))]
-        ended_sentences = []
-        min_length = 0
-        max_length = 30
-        min_count = min(beam, len(active_sentences))
-        for seqidx in xrange(max_length):
-            tmp_sentences = []
-            for i in xrange(min_count):
-                states_dict  = active_sentences[i][2]
-                for key in states_dict.keys():
-                    states_dict[key].copyto(decoder_executor.arg_dict[key])
-                decoder_executor.arg_dict["dec_data"][:] = active_sentences[i][1][-1]
-                decoder_executor.forward()
-                new_states_dict = dict(zip(state_name, decoder_executor.outputs[1:]))
-                tmp_states_dict = copy.deepcopy(new_states_dict)
+        state_name = ['%s_l0_init_h' % self.dec_name]
 
-                prob = decoder_executor.outputs[0].asnumpy()
-                # === this order is from small to big =====
-                indecies = np.argsort(prob, axis = 1)[0]
-
-                for j in xrange(beam):
-                    score = active_sentences[i][0] + math.log(prob[0][indecies[-j-1]])
-                    sent = active_sentences[i][1][:]
-                    sent.extend([indecies[-j-1]])
-                    if sent[-1] == eos:
-                        if seqidx >= min_length:
-                            ended_sentences.append((score, sent))
-                    elif sent[-1] != unk and sent[-1] != pad:
-                        tmp_sentences.append((score, sent, tmp_states_dict))
-
-            min_count = min(beam, len(tmp_sentences))
-            active_sentences = sorted(tmp_sentences, reverse = True)[:min_count]
-        result_sentences = []
-        for sent in active_sentences:
-            result_sentences.append((sent[0], sent[1]))
-        for sent in ended_sentences:
-            result_sentences.append(sent)
-        #result = min(beam, len(result_sentences), 10)
-        #result_sentences = sorted(result_sentences, reverse = True)[:result]
-        result_sentences = sorted(result_sentences, reverse = True)
-        return result_sentences
+        # --------------------------- beam search ---------------------------------
+        searcher = BeamSearch(
+            beam = beam, 
+            max_length = 30, 
+            min_length = 0, 
+            pad = pad, 
+            eos = eos, 
+            unk = unk,
+            early_stop = early_stop,
+            prune_margin = prune_margin,
+            deadline = end_time
+        )
+        results = []
+        for active_sentences, ended_sentences in searcher.search(
+                decoder_executor, state_name, encoder_executor.outputs[:]):
+            result_sentences = active_sentences + ended_sentences
+            #result = min(beam, len(result_sentences), 10)
+            #result_sentences = sorted(result_sentences, reverse = True)[:result]
+            result_sentences = sorted(result_sentences, reverse = True)
+            results.append(result_sentences)
+        self.search_stats = searcher.stats
+        return results
 
-    def couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2):
+    def batch_couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 20, executors = None,
+                constraints = None, deadline = None):
+        '''constraints: per position word constraints, see beam_search.punctuation_constraints
+        deadline: latency budget in seconds, see batch_predict; the lines of a truncated search
+            are partial (shorter than the upper line, rescore of train.py drops them), their
+            sentences are counted in self.search_stats['incomplete']
+        '''
+        end_time = None if deadline is None else time.time() + deadline
         # ------------------------- bind data to symbol ---------------------------
-        encoder, decoder = self.symbol_define()
-        input_shapes = {}
-        input_shapes['enc_data'] = (1, self.enc_len)
-        encoder_executor = encoder.simple_bind(ctx = mx.cpu(), **input_shapes)
-        for key in encoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(encoder_executor.arg_dict[key])
+        if executors is None:
+            executors = self.bind_executors(arg_params, beam, enc_data.shape[0])
+        encoder_executor, decoder_executor = executors
         enc_data.copyto(encoder_executor.arg_dict['enc_data'])
         encoder_executor.forward()
-        dec_init_states = [('%s_l0_init_h' % self.dec_name, (1, self.dec_num_hidden))]
-        state_name = [item[0] for item in dec_init_states]
-        init_states_dict = dict(zip(state_name, encoder_executor.outputs[:]))
-        dec_data_shape = [("dec_data", (1,1))]
-        dec_input_shapes = dict(dec_data_shape + dec_init_states) 
-        decoder_executor = decoder.simple_bind(ctx = mx.cpu(), **dec_input_shapes)
-        for key in decoder_executor.arg_dict:
-            if key in arg_params:
-                arg_params[key].copyto(decoder_executor.arg_dict[key])
-        
+        state_name = ['%s_l0_init_h' % self.dec_name]
+
         # --------------------------- beam search ---------------------------------
-        dec_data = mx.nd.zeros((1,1))
-        beam = 20
-        active_sentences = [(0,[eos], copy.deepcopy(init_states_dict))]
-        ended_sentences = []
-        min_length = 0
-        max_length = enc_data.shape[1]
-        min_count = min(beam, len(active_sentences))
-        for seqidx in xrange(max_length):
-            tmp_sentences = []
-            for i in xrange(min_count):
-                states_dict  = active_sentences[i][2]
-                for key in states_dict.keys():
-                    states_dict[key].copyto(decoder_executor.arg_dict[key])
-                decoder_executor.arg_dict["dec_data"][:] = active_sentences[i][1][-1]
-                decoder_executor.forward()
-                new_states_dict = dict(zip(state_name, decoder_executor.outputs[1:]))
-                tmp_states_dict = copy.deepcopy(new_states_dict)
+        searcher = BeamSearch(
+            beam = beam, 
+            max_length = enc_data.shape[1], 
+            min_length = 0, 
+            pad = pad, 
+            eos = eos, 
+            unk = unk,
+            keep_ended = False,
+            deadline = end_time
+        )
+        results = []
+        for active_sentences, _ in searcher.search(
+                decoder_executor, state_name, encoder_executor.outputs[:], constraints = constraints):
+            result_sentences = []
+            for sent in active_sentences:
+                result_sentences.append((sent[0], sent[1][1:]))
+            #result = min(beam, len(result_sentences), 10)
+            #result_sentences = sorted(result_sentences, reverse = True)[:result]
+            result_sentences = sorted(result_sentences, reverse = True)
+            results.append(result_sentences)
+        self.search_stats = searcher.stats
+        return results
+
+    def predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 10, executors = None,
+                early_stop = False, prune_margin = None, deadline = None):
+        return self.batch_predict(enc_data, arg_params, pad, eos, unk, beam, executors, early_stop, prune_margin, deadline)[0]
 
-                prob = decoder_executor.outputs[0].asnumpy()
-                # === this order is from small to big =====
-                indecies = np.argsort(prob, axis = 1)[0]
-                for j in xrange(beam):
-                    score = active_sentences[i][0] + math.log(prob[0][indecies[-j-1]])
-                    sent = active_sentences[i][1][:]
-                    sent.extend([indecies[-j-1]])
-                    if sent[-1] != eos and sent[-1] != unk and sent[-1] != pad:
-                        tmp_sentences.append((score, sent, tmp_states_dict))
-            min_count = min(beam, len(tmp_sentences))
-            active_sentences = sorted(tmp_sentences, reverse = True)[:min_count]
-        result_sentences = []
-        for sent in active_sentences:
-            result_sentences.append((sent[0], sent[1][1:]))
-        #result = min(beam, len(result_sentences), 10)
-        #result_sentences = sorted(result_sentences, reverse = True)[:result]
-        result_sentences = sorted(result_sentences, reverse = True)
-        return result_sentences
\ No newline at end of file
+    def couplet_predict(self, enc_data, arg_params, pad = 0, eos = 1, unk = 2, beam = 20, executors = None,
+                constraints = None, deadline = None):
+        return self.batch_couplet_predict(enc_data, arg_params, pad, eos, unk, beam, executors, constraints, deadline)[0]
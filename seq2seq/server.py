@@ -0,0 +1,290 @@
+#-*- coding:utf-8 -*-
+'''Local inference server with dynamic request batching
+
+The checkpoint is loaded once into an InferenceSession. The incoming requests are
+queued, a single worker collects them for at most max_wait seconds (or until
+max_batch are queued), groups them by encoder length and decodes every group as
+one batch. The groups are padded to a power of two sentences (InferenceSession
+pad_batches), so the executors of a few batch sizes per length stay bound.
+
+Two protocols:
+    HTTP on localhost: POST /predict with {"text": "w1 w2 ..."}
+    stdin/stdout JSONL (--stdin): one {"id": ..., "text": "w1 w2 ..."} per line,
+        the responses are written as soon as their batch is decoded
+
+Response: {"id", "text", "results": [{"score", "sentence"}], "batch_size", "latency"}
+the latency (seconds) is measured from the arrival of the request.
+GET /stats returns the counters of the encoder cache (--cache-mb).
+
+Example:
+    python server.py --task couplet --model global --data-dir ../data/couplet/data/final \
+        --enc-vocab alllist.txt --dec-vocab alllist.txt --share-embed \
+        --params ../data/couplet/global_params/couplet --epoch 6 --port 8080
+'''
+
+import sys, os, argparse, json, time, threading, codecs
+import Queue
+import BaseHTTPServer, SocketServer
+import functools
+
+import mxnet as mx
+import numpy as np
+
+from enc_dec_iter import read_dict
+from seq2seq import Seq2Seq
+from focus_attention import FocusSeq2Seq
+from global_attention import GlobalSeq2Seq
+from inference import InferenceSession, length_batches
+from beam_search import punctuation_constraints
+
+class PendingRequest(object):
+    '''A queued request, the worker sets response and the event when it is decoded'''
+    def __init__(self, text, data, request_id = None, callback = None):
+        super(PendingRequest, self).__init__()
+        self.text = text
+        self.data = data
+        self.request_id = request_id
+        self.callback = callback
+        self.arrival = time.time()
+        self.response = None
+        self.done = threading.Event()
+
+class BatchingServer(object):
+    '''Queue of requests decoded in batches by one worker thread
+
+    All the mxnet calls are made from the worker thread.
+
+    Args:
+        session: InferenceSession
+        task: couplet uses couplet_predict with the punctuation constraints, others predict
+        max_batch: max sentences decoded together
+        max_wait: max seconds the first queued request waits for others to join its batch
+        nbest: number of results returned per request
+    '''
+    def __init__(self, session, enc_word2idx, dec_word2idx, task, max_batch = 16, max_wait = 0.01, nbest = 10):
+        super(BatchingServer, self).__init__()
+        self.session = session
+        self.enc_word2idx = enc_word2idx
+        self.dec_idx2word = dict((v, k) for k, v in dec_word2idx.items())
+        self.num_words = len(dec_word2idx)
+        self.task = task
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.nbest = nbest
+        # the couplet lines have their punctuation at the same positions
+        self.punctuation = [(enc_word2idx[w], dec_word2idx[w]) for w in [u'，', u'。']
+            if w in enc_word2idx and w in dec_word2idx]
+        self.queue = Queue.Queue()
+        self.worker = threading.Thread(target = self.run)
+        self.worker.daemon = True
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, text, request_id = None, callback = None):
+        '''Queue a sentence, returns the PendingRequest'''
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+        unk = self.enc_word2idx.get('<unk>')
+        data = [self.enc_word2idx.get(item, unk) for item in text.strip().split()]
+        request = PendingRequest(text, data, request_id, callback)
+        self.queue.put(request)
+        return request
+
+    def collect(self):
+        '''Block for a request, then gather the others arrived within max_wait'''
+        requests = [self.queue.get()]
+        deadline = requests[0].arrival + self.max_wait
+        while len(requests) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout = timeout))
+            except Queue.Empty:
+                break
+        return requests
+
+    def run(self):
+        while True:
+            requests = self.collect()
+            for indices in length_batches([request.data for request in requests], self.max_batch):
+                group = [requests[i] for i in indices]
+                try:
+                    results = self.decode([request.data for request in group])
+                except Exception as e:
+                    results = [e] * len(group)
+                for request, result in zip(group, results):
+                    try:
+                        self.respond(request, result, len(group))
+                    except Exception as e:
+                        self.fail(request, e, len(group))
+
+    def decode(self, data):
+        if len(data[0]) == 0:
+            return [[] for _ in data]
+        enc_data = mx.nd.array(np.array(data))
+        if self.task == 'couplet':
+            constraints = punctuation_constraints(np.array(data), self.punctuation, self.num_words)
+            return self.session.batch_couplet_predict(enc_data, constraints = constraints)
+        return self.session.batch_predict(enc_data)
+
+    def respond(self, request, result, batch_size):
+        response = {'id' : request.request_id, 'text' : request.text, 'batch_size' : batch_size}
+        if isinstance(result, Exception):
+            response['error'] = str(result)
+        else:
+            response['results'] = [{'score' : float(score), 'sentence' : self.to_text(sent)}
+                for score, sent in result[:self.nbest]]
+        response['latency'] = time.time() - request.arrival
+        request.response = response
+        request.done.set()
+        if request.callback is not None:
+            request.callback(response)
+
+    def fail(self, request, error, batch_size):
+        '''respond raised: the request still gets an error response, so its waiters
+        and the worker thread go on (nothing to do if only its callback raised)'''
+        if request.done.is_set():
+            return
+        request.response = {
+            'id' : request.request_id,
+            'text' : request.text,
+            'batch_size' : batch_size,
+            'error' : str(error),
+            'latency' : time.time() - request.arrival
+        }
+        request.done.set()
+        if request.callback is not None:
+            try:
+                request.callback(request.response)
+            except Exception:
+                pass
+
+    def to_text(self, sent):
+        words = [self.dec_idx2word[idx] for idx in sent]
+        return ' '.join([word for word in words if word != '<eos>'])
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def make_handler(server):
+    class PredictHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.getheader('content-length', 0))
+                body = json.loads(self.rfile.read(length))
+                text = body['text']
+                if not isinstance(text, basestring):
+                    raise TypeError('text is not a string')
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400, 'expect {"text": "w1 w2 ..."}')
+                return
+            request = server.submit(text, body.get('id'))
+            request.done.wait()
+            output = json.dumps(request.response, ensure_ascii = False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            cache = server.session.encoder_cache
+            output = json.dumps(cache.stats() if cache is not None else {})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def log_message(self, format, *args):
+            pass
+    return PredictHandler
+
+def serve_stdin(server):
+    '''JSONL protocol, the requests are all queued as they are read'''
+    lock = threading.Lock()
+    def write(response):
+        with lock:
+            sys.stdout.write(json.dumps(response, ensure_ascii = False).encode('utf-8') + '\n')
+            sys.stdout.flush()
+    pending = []
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        body = json.loads(line)
+        pending.append(server.submit(body['text'], body.get('id'), write))
+    for request in pending:
+        request.done.wait()
+
+def add_model_arguments(parser):
+    '''The arguments of load_model, shared with benchmark.py'''
+    parser.add_argument('--task', default = 'stc', type = str, help = 'couplet or other')
+    parser.add_argument('--model', default = 'seq2seq', type = str, help = 'seq2seq, focus, global, local')
+    parser.add_argument('--data-dir', required = True, type = str, help = 'directory of the vocabularies')
+    parser.add_argument('--enc-vocab', default = 'post.vocab', type = str)
+    parser.add_argument('--dec-vocab', default = 'cmnt.vocab', type = str)
+    parser.add_argument('--share-embed', action = 'store_true', help = 'the model shares the embedding weight')
+    parser.add_argument('--params', required = True, type = str, help = 'checkpoint prefix')
+    parser.add_argument('--epoch', default = 6, type = int, help = 'checkpoint epoch')
+
+def load_model(args):
+    '''Outputs:
+            Model, enc_word2idx, dec_word2idx, arg_params, model_args (the arguments of InferenceSession)
+    '''
+    if args.model == 'seq2seq':
+        Model = Seq2Seq
+    elif args.model == 'global':
+        Model = GlobalSeq2Seq
+    elif args.model == 'local':
+        Model = functools.partial(GlobalSeq2Seq, attention_type = 'local')
+    else:
+        Model = FocusSeq2Seq
+    enc_word2idx = read_dict(os.path.join(args.data_dir, args.enc_vocab))
+    dec_word2idx = read_dict(os.path.join(args.data_dir, args.dec_vocab))
+    _, arg_params, _ = mx.model.load_checkpoint(args.params, args.epoch)
+    model_args = {
+        'enc_input_size' : len(enc_word2idx),
+        'dec_input_size' : len(dec_word2idx),
+        'num_label' : len(dec_word2idx),
+        'share_embed_weight' : args.share_embed
+    }
+    return Model, enc_word2idx, dec_word2idx, arg_params, model_args
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Encoder-Decoder Model Server')
+    add_model_arguments(parser)
+    parser.add_argument('--beam', default = None, type = int, help = 'default 20 for couplet, 10 otherwise')
+    parser.add_argument('--max-batch', default = 16, type = int, help = 'max sentences decoded together')
+    parser.add_argument('--max-wait', default = 0.01, type = float, help = 'max seconds a request waits for a batch')
+    parser.add_argument('--nbest', default = 10, type = int)
+    parser.add_argument('--max-lengths', default = 32, type = int, help = 'sentence lengths whose executors stay bound')
+    parser.add_argument('--cache-mb', default = 256, type = int, help = 'encoder cache size, 0 disables it')
+    parser.add_argument('--cache-nbest', action = 'store_true', help = 'cache the finished n-best lists too')
+    parser.add_argument('--port', default = 8080, type = int, help = 'HTTP port on localhost')
+    parser.add_argument('--stdin', action = 'store_true', help = 'JSONL on stdin/stdout instead of HTTP')
+    args = parser.parse_args()
+
+    Model, enc_word2idx, dec_word2idx, arg_params, model_args = load_model(args)
+    beam = args.beam
+    if beam is None:
+        beam = 20 if args.task == 'couplet' else 10
+    session = InferenceSession(Model, arg_params, beam = beam, 
+        max_cached = InferenceSession.cache_size(args.max_lengths, args.max_batch, pad_batches = True),
+        cache_bytes = args.cache_mb << 20, cache_nbest = args.cache_nbest, pad_batches = True, **model_args)
+    server = BatchingServer(session, enc_word2idx, dec_word2idx, args.task,
+        max_batch = args.max_batch, max_wait = args.max_wait, nbest = args.nbest)
+    server.start()
+    if args.stdin:
+        serve_stdin(server)
+    else:
+        httpd = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(server))
+        sys.stderr.write('serving on http://127.0.0.1:%d/predict\n' % args.port)
+        httpd.serve_forever()
@@ -0,0 +1,174 @@
+#-*- coding:utf-8 -*-
+'''Vocabulary shortlist of the decoder output layer
+
+At inference the output layer (dec_pred) and the softmax only cover a fixed number
+of candidate words per batch instead of the whole vocabulary: the special words,
+the words co-occurring with the source words in the training pairs (for the
+shared couplet vocabulary, the characters paired with the input characters) and
+then the most frequent target words. The decoder gathers the rows of
+dec_pred_weight / dec_pred_bias given by its 'shortlist' input, and the beam search
+maps the output columns back to word ids.
+
+Decode throughput and agreement with the full vocabulary decoding:
+    python shortlist.py --task couplet --model global --data-dir ../data/couplet/data/final \
+        --enc-vocab alllist.txt --dec-vocab alllist.txt --share-embed \
+        --params ../data/couplet/global_params/couplet --epoch 6 --size 2000
+'''
+
+import os, argparse, time
+import cPickle as pickle
+from collections import defaultdict, Counter
+
+import mxnet as mx
+import numpy as np
+
+def output_layer(data, num_label, name, shortlist_size = None):
+    '''The FullyConnected output layer of the decoder
+
+    With shortlist_size, only the rows of name_weight / name_bias given by the
+    'shortlist' input (word ids with shape (shortlist_size, )) are gathered, so the
+    output has shortlist_size columns instead of num_label.
+    '''
+    if shortlist_size is None:
+        return mx.sym.FullyConnected(data = data, num_hidden = num_label, name = name)
+    shortlist = mx.sym.Variable('shortlist')
+    weight = mx.sym.take(mx.sym.Variable('%s_weight' % name), shortlist)
+    bias = mx.sym.take(mx.sym.Variable('%s_bias' % name), shortlist)
+    return mx.sym.FullyConnected(data = data, weight = weight, bias = bias, num_hidden = shortlist_size, name = name)
+
+def forced_words(constraints):
+    '''The word ids forced by the constraints of BeamSearch.search (numpy array with shape
+    (batch_size, max_length, num_words)): the only finite word of a position, e.g. the
+    punctuation of punctuation_constraints. They have to be in the shortlist, otherwise
+    every candidate of their position is -inf.
+    '''
+    finite = np.isfinite(constraints)
+    forced = finite[finite.sum(axis = 2) == 1]
+    return sorted(set(np.nonzero(forced)[1].tolist()))
+
+class Shortlist(object):
+    '''Fixed size candidate words of a batch
+
+    Args:
+        frequent: target word ids by decreasing frequency
+        cooccur: dict source word id -> target word ids by decreasing co-occurrence
+        size: number of candidates, the shortlist_size the decoders are bound at
+        special: ids always in the shortlist (pad, eos, unk)
+    '''
+    def __init__(self, frequent, cooccur, size, special = (0, 1, 2)):
+        super(Shortlist, self).__init__()
+        self.frequent = list(frequent)
+        self.cooccur = cooccur
+        self.size = size
+        self.special = list(special)
+
+    @staticmethod
+    def build(enc_data, dec_data, size, num_words, num_cooccur = 50, special = (0, 1, 2)):
+        '''Count the target words and the source / target co-occurrences of the training pairs,
+        num_words: target vocabulary size, the words never seen are the last frequent ones
+        '''
+        frequency = Counter()
+        pairs = defaultdict(Counter)
+        for enc, dec in zip(enc_data, dec_data):
+            frequency.update(dec)
+            for word in set(enc):
+                pairs[word].update(dec)
+        frequent = [word for word, _ in frequency.most_common()]
+        frequent += sorted(set(xrange(num_words)) - set(frequent))
+        cooccur = dict((word, [target for target, _ in counter.most_common(num_cooccur)])
+            for word, counter in pairs.items())
+        return Shortlist(frequent, cooccur, size, special)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump((self.frequent, self.cooccur, self.size, self.special), f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            frequent, cooccur, size, special = pickle.load(f)
+        return Shortlist(frequent, cooccur, size, special)
+
+    def candidates(self, enc_data, required = None):
+        '''enc_data: (batch_size, enc_len) source word ids
+        required: other word ids always in the candidates, e.g. the words forced by the
+            constraints of the batch (see forced_words)
+            Outputs:
+                numpy array with shape (size, ), the special and required words, the
+                co-occurring words of the batch by rank, then the frequent words
+        '''
+        ranked = [self.cooccur.get(word, []) for word in set(np.asarray(enc_data, dtype = 'int64').reshape(-1).tolist())]
+        words = list(self.special)
+        seen = set(words)
+        for word in (required if required is not None else []):
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        for rank in xrange(max([len(item) for item in ranked] + [0])):
+            for item in ranked:
+                if rank < len(item) and item[rank] not in seen:
+                    seen.add(item[rank])
+                    words.append(item[rank])
+        for word in self.frequent:
+            if len(words) >= self.size:
+                break
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return np.array(words[:self.size], dtype = 'float32')
+
+if __name__ == '__main__':
+    from enc_dec_iter import get_enc_dec_text_id
+    from inference import InferenceSession
+    from beam_search import punctuation_constraints
+    from server import add_model_arguments, load_model
+    from benchmark import read_test_file
+
+    parser = argparse.ArgumentParser(description = 'Shortlist decoding throughput and agreement with the full vocabulary')
+    add_model_arguments(parser)
+    parser.add_argument('--train-file', default = 'train.txt', type = str, help = 'pairs the shortlist is counted on')
+    parser.add_argument('--test-file', default = 'test.txt', type = str, help = 'post\\t=>\\tcmnt file in data-dir')
+    parser.add_argument('--num', default = 300, type = int, help = 'number of test posts')
+    parser.add_argument('--size', default = 2000, type = int, help = 'shortlist size')
+    parser.add_argument('--batch-size', default = 16, type = int, help = 'sentences decoded together')
+    args = parser.parse_args()
+
+    Model, enc_word2idx, dec_word2idx, arg_params, model_args = load_model(args)
+    enc_train, dec_train = get_enc_dec_text_id(os.path.join(args.data_dir, args.train_file), enc_word2idx, dec_word2idx)
+    shortlist = Shortlist.build(enc_train, dec_train, min(args.size, len(dec_word2idx)), len(dec_word2idx))
+    posts = read_test_file(os.path.join(args.data_dir, args.test_file), enc_word2idx, args.num)
+    punctuation = [(enc_word2idx[w], dec_word2idx[w]) for w in [u'，', u'。']
+        if w in enc_word2idx and w in dec_word2idx]
+    beam = 20 if args.task == 'couplet' else 10
+    groups = defaultdict(list)
+    for data, _ in posts:
+        groups[len(data)].append(data)
+    batches = [group[i:i+args.batch_size] for group in groups.values() for i in xrange(0, len(group), args.batch_size)]
+
+    outputs = {}
+    for name, session_shortlist in [('full', None), ('shortlist', shortlist)]:
+        # all the executors stay bound, none is bound inside the timing
+        session = InferenceSession(Model, arg_params, beam = beam, shortlist = session_shortlist, 
+            max_cached = InferenceSession.cache_size(len(set([(len(batch[0]), len(batch)) for batch in batches]))), **model_args)
+        for batch in batches:
+            session.get(len(batch[0]), len(batch))
+        results = []
+        start = time.time()
+        for batch in batches:
+            enc_data = np.array(batch)
+            if args.task == 'couplet':
+                constraints = punctuation_constraints(enc_data, punctuation, len(dec_word2idx))
+                results += session.batch_couplet_predict(mx.nd.array(enc_data), constraints = constraints)
+            else:
+                results += session.batch_predict(mx.nd.array(enc_data))
+        elapsed = time.time() - start
+        outputs[name] = results
+        print '%-10s %8.2f sentences/s' % (name, len(results) / elapsed)
+    same, overlap = 0, 0.
+    for full, short in zip(outputs['full'], outputs['shortlist']):
+        if len(full) > 0 and len(short) > 0 and full[0][1] == short[0][1]:
+            same += 1
+        full_top = set([tuple(sent) for _, sent in full[:10]])
+        short_top = set([tuple(sent) for _, sent in short[:10]])
+        overlap += len(full_top & short_top) / float(max(len(full_top), 1))
+    print 'same best hypothesis: %d / %d, top-10 overlap: %.3f' % (same, len(posts), overlap / max(len(posts), 1))
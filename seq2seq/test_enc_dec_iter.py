@@ -0,0 +1,46 @@
+#-*- coding:utf-8 -*-
+'''Tests of the bucketing iterators (run with pytest from seq2seq/)'''
+
+import os, sys
+
+import pytest
+import numpy as np
+
+mx = pytest.importorskip('mxnet')
+pytest.importorskip('sklearn')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from enc_dec_iter import EncoderDecoderIter
+
+def pairs_with_oversized():
+    '''Pairs fitting the buckets (3, 4) and (5, 6), plus one longer encoder and one
+    longer decoder than the largest bucket'''
+    enc_data = [[3, 4], [5, 6, 7], [3, 4, 5, 6], [8, 9, 10, 11, 12]] * 2
+    dec_data = [[4, 5], [6], [7, 8, 9], [10, 11, 12, 13]] * 2
+    enc_data += [[3] * 9, [4, 5]]
+    dec_data += [[6, 7], [8] * 9]
+    return enc_data, dec_data
+
+def test_oversized_pairs_skipped():
+    enc_data, dec_data = pairs_with_oversized()
+    data_iter = EncoderDecoderIter(enc_data, dec_data, 2, [(3, 4), (5, 6)], shuffle = False)
+    assert data_iter.skipped == 2
+    assert sum([len(data) for data in data_iter.enc_data]) == len(enc_data) - 2
+    batches = list(data_iter)
+    assert len(batches) == 4
+    for batch in batches:
+        enc_mask, dec_mask = batch.data[1].asnumpy(), batch.data[3].asnumpy()
+        label = batch.label[0].asnumpy()
+        # every decoder sentence ends with eos inside its bucket
+        assert np.all((label == 1).sum(axis = 1) == 1)
+        assert np.all(dec_mask.sum(axis = 1) == (label > 0).sum(axis = 1))
+        assert np.all(enc_mask.sum(axis = 1) <= batch.bucket_key[0])
+
+def test_oversized_pairs_skipped_length_inputs():
+    enc_data, dec_data = pairs_with_oversized()
+    data_iter = EncoderDecoderIter(enc_data, dec_data, 2, [(3, 4), (5, 6)], shuffle = False, length_inputs = True)
+    assert data_iter.skipped == 2
+    for batch in data_iter:
+        enc_len, dec_len = batch.bucket_key
+        assert np.all(batch.data[1].asnumpy() <= enc_len)
+        assert np.all(batch.data[3].asnumpy() + 1 <= dec_len)
@@ -7,15 +7,21 @@ import re, os, sys, argparse, logging, collections
 import codecs
 import math
 import random
+import functools
+import time
+import subprocess
+import multiprocessing
 from collections import defaultdict
 
-from enc_dec_iter import EncoderDecoderIter, read_dict, get_enc_dec_text_id, generate_buckets
+from enc_dec_iter import EncoderDecoderIter, StreamingEncoderDecoderIter, RaggedPairs, read_dict, generate_buckets
+from corpus_cache import load_enc_dec_corpus
 from seq2seq import Seq2Seq
 from focus_attention import FocusSeq2Seq
 from global_attention import GlobalSeq2Seq
-from eval_and_visual import read_file
+from inference import InferenceSession, length_batches
+from beam_search import punctuation_constraints
+from eval_and_visual import write_record, write_end, merge_records, records_bleu
 from metric import PerplexityWithoutExp
-from nltk.translate.bleu_score import corpus_bleu
 
 def rescore(string, results):
     res = []
@@ -45,10 +51,18 @@ if __name__ == '__main__':
     parser.add_argument('--task', default = 'sort', type = str, 
         help='which task: stc, couplet, or other')
     parser.add_argument('--model', default = 'seq2seq', type = str,
-        help='which model: seq2seq, focus_attention_seq2seq, global_attention_seq2seq')
+        help='which model: seq2seq, focus, global, local (global with local attention)')
     
     parser.add_argument('--testepoch', default = '6', type = int,
         help='test epoch')
+    parser.add_argument('--workers', default = 1, type = int,
+        help='generate mode: number of decoding processes')
+    parser.add_argument('--threads', default = None, type = int,
+        help='generate mode: intra-op threads (OMP_NUM_THREADS) of every worker, default cores / workers')
+    parser.add_argument('--scaling', action = 'store_true',
+        help='generate mode: time the decoding with 1 to --workers workers')
+    parser.add_argument('--shard', default = None, type = int,
+        help='internal, set for the decoding workers: decode the posts shard, shard + workers, ...')
     args = parser.parse_args()
     print args
     mode = args.mode
@@ -59,6 +73,8 @@ if __name__ == '__main__':
         Model = Seq2Seq
     elif model == 'global':
         Model = GlobalSeq2Seq
+    elif model == 'local':
+        Model = functools.partial(GlobalSeq2Seq, attention_type = 'local')
     else:
         Model = FocusSeq2Seq
 
@@ -104,6 +120,9 @@ if __name__ == '__main__':
     enc_word2idx = read_dict(os.path.join(data_dir, enc_vocab_file))
     dec_word2idx = read_dict(os.path.join(data_dir, dec_vocab_file))
     ignore_label = dec_word2idx.get('<pad>')
+    # the couplet lines have their punctuation at the same positions
+    punctuation = [(enc_word2idx[w], dec_word2idx[w]) for w in [u'，', u'。'] 
+        if w in enc_word2idx and w in dec_word2idx]
     # ----------------- 1. Configure logging module  ---------------------------------------
     # This is needed only in train mode
     if mode == 'train':
@@ -122,6 +141,10 @@ if __name__ == '__main__':
     # -----------------2. Params Defination ----------------------------------------
     num_buckets = 4
     batch_size = 32
+    decode_batch_size = 16 # sentences decoded together in generate mode
+    num_generate = None # posts decoded in generate mode, None for the whole test file
+    stream_buffer_size = None # shuffle buffer (pairs) of the streaming train iterator, None to pad all the corpus
+    length_inputs = False # feed the lengths, the masks and the label are computed in the graph
 
     seed = 1
     random.seed(seed)
@@ -136,35 +159,54 @@ if __name__ == '__main__':
             dec_len = bucketkey[1],
             num_label = len(dec_word2idx),
             share_embed_weight = share_embed_weight,
-            is_train = True
+            is_train = True,
+            eos = enc_word2idx.get('<eos>'),
+            length_inputs = length_inputs
         )
         softmax_symbol = seq2seq.symbol_define()
         data_names = ['enc_data', 'enc_mask', 'dec_data', 'dec_mask']
         label_names = ['label']
+        if length_inputs:
+            data_names = ['enc_data', 'enc_length', 'dec_data', 'dec_length']
+            label_names = []
         return (softmax_symbol, data_names, label_names)
 
     if mode == 'train':
-        enc_train, dec_train = get_enc_dec_text_id(os.path.join(data_dir, train_file), enc_word2idx, dec_word2idx)
-        enc_valid, dec_valid = get_enc_dec_text_id(os.path.join(data_dir, valid_file), enc_word2idx, dec_word2idx)
+        # the corpora are tokenized once, the later runs map the compiled cache
+        enc_train, dec_train = load_enc_dec_corpus(os.path.join(data_dir, train_file), enc_word2idx, dec_word2idx)
+        enc_valid, dec_valid = load_enc_dec_corpus(os.path.join(data_dir, valid_file), enc_word2idx, dec_word2idx)
 
         # ----------------------3. Data Iterator Defination ---------------------
-        sequence_length = []
-        for i in range(len(enc_train)):
-            sequence_length.append((len(enc_train[i]), len(dec_train[i])+1))
-        for i in range(len(enc_valid)):
-            sequence_length.append((len(enc_valid[i]), len(dec_valid[i])+1))
+        sequence_length = np.concatenate([
+            np.column_stack([enc_train.lengths, dec_train.lengths + 1]),
+            np.column_stack([enc_valid.lengths, dec_valid.lengths + 1])
+        ])
 
         buckets = generate_buckets(sequence_length, num_buckets)
 
-        train_iter = EncoderDecoderIter(
-            enc_data = enc_train, 
-            dec_data = dec_train, 
-            batch_size = batch_size, 
-            buckets = buckets, 
-            shuffle = True,
-            pad = enc_word2idx.get('<pad>'), 
-            eos = enc_word2idx.get('<eos>')
-        )
+        if stream_buffer_size is None:
+            train_iter = EncoderDecoderIter(
+                enc_data = enc_train, 
+                dec_data = dec_train, 
+                batch_size = batch_size, 
+                buckets = buckets, 
+                shuffle = True,
+                pad = enc_word2idx.get('<pad>'), 
+                eos = enc_word2idx.get('<eos>'),
+                length_inputs = length_inputs
+            )
+        else:
+            # bounded memory: the pairs are read from the mapped corpus through a shuffle buffer
+            train_iter = StreamingEncoderDecoderIter(
+                source = RaggedPairs(enc_train, dec_train), 
+                batch_size = batch_size, 
+                buckets = buckets, 
+                shuffle = True,
+                pad = enc_word2idx.get('<pad>'), 
+                eos = enc_word2idx.get('<eos>'),
+                buffer_size = stream_buffer_size,
+                length_inputs = length_inputs
+            )
         valid_iter = EncoderDecoderIter(
             enc_data = enc_valid, 
             dec_data = dec_valid, 
@@ -172,7 +214,8 @@ if __name__ == '__main__':
             buckets = buckets,
             shuffle = False, 
             pad = enc_word2idx.get('<pad>'), 
-            eos = enc_word2idx.get('<eos>')
+            eos = enc_word2idx.get('<eos>'),
+            length_inputs = length_inputs
         )
         frequent = train_iter.data_len / batch_size / 10 # log frequency
         # ------------------4. Load paramters if exists ------------------------------
@@ -222,6 +265,19 @@ if __name__ == '__main__':
         )
     elif mode == 'test':
         sym, arg_params, aux_params = mx.model.load_checkpoint('%s%s' % (params_dir, params_prefix), testepoch)
+        # the executors are bound once per encoder length and reused,
+        # the encoder outputs and n-best lists of repeated inputs are cached
+        session = InferenceSession(
+            Model, 
+            arg_params, 
+            beam = 20 if task == 'couplet' else 10,
+            cache_bytes = 64 << 20,
+            cache_nbest = True,
+            enc_input_size = len(enc_word2idx), 
+            dec_input_size = len(dec_word2idx),
+            num_label = len(dec_word2idx),
+            share_embed_weight = share_embed_weight
+        )
         dec_idx2word = {}
         for k, v in dec_word2idx.items():
             dec_idx2word[v] = k
@@ -243,22 +299,14 @@ if __name__ == '__main__':
                     data.append(enc_word2idx.get(item))
             enc_data = mx.nd.array(np.array(data).reshape(1, enc_len))
             # --------------------- beam seqrch ------------------          
-            seq2seq = Model(
-                enc_input_size = len(enc_word2idx), 
-                dec_input_size = len(dec_word2idx),
-                enc_len = enc_len,
-                dec_len = 1,
-                num_label = len(dec_word2idx),
-                share_embed_weight = share_embed_weight,
-                is_train = False
-            )
             input_str = ""
             enc_list = enc_data.asnumpy().reshape(-1,).tolist()
             for i in enc_list:
                 input_str += " " +  enc_idx2word[int(i)]
 
             if task == 'couplet':
-                results = seq2seq.couplet_predict(enc_data, arg_params)
+                constraints = punctuation_constraints(enc_data.asnumpy(), punctuation, len(dec_word2idx))
+                results = session.couplet_predict(enc_data, constraints = constraints)
                 res = []
                 for pair in results:
                     sent = pair[1]
@@ -276,7 +324,7 @@ if __name__ == '__main__':
                 for pair in results[0:minmum]:
                     print "score : %f, %s" % (pair[0], pair[1]) 
             else:
-                results = seq2seq.predict(enc_data, arg_params)
+                results = session.predict(enc_data)
                 # ---------------------- print result ------------------
                 print "Encode Sentence: ", input_str
                 print 'Beam Search Results: '
@@ -291,35 +339,36 @@ if __name__ == '__main__':
                         mystr += " " +  dec_idx2word[idx]
                     print "score : %f, %s" % (score, mystr)            
     else:
-        enc_test, dec_test = get_enc_dec_text_id(os.path.join(data_dir, test_file), enc_word2idx, dec_word2idx)
-        sequence_length = []
-        for i in range(len(enc_test)):
-            sequence_length.append((len(enc_test[i]), len(dec_test[i])+1))
-        buckets = generate_buckets(sequence_length, num_buckets)
-        test_iter = EncoderDecoderIter(
-            enc_data = enc_test, 
-            dec_data = dec_test, 
-            batch_size = batch_size, 
-            buckets = buckets, 
-            shuffle = False,
-            pad = enc_word2idx.get('<pad>'), 
-            eos = enc_word2idx.get('<eos>')
-        )
-        if num_buckets == 1:
-            mod = mx.mod.Module(*sym_gen(test_iter.default_bucket_key), context = [mx.gpu(0)])
-        else:
-            mod = mx.mod.BucketingModule(
-                sym_gen = sym_gen, 
-                default_bucket_key = test_iter.default_bucket_key, 
-                context = [mx.gpu(0)]
-            )
         epoch = 2
         sym, arg_params, aux_params = mx.model.load_checkpoint('%s%s' % (params_dir, params_prefix), epoch)
-        mod.bind(data_shapes=test_iter.provide_data, label_shapes = test_iter.provide_label)
-        mod.set_params(arg_params=arg_params, aux_params=aux_params)
-        res  = mod.score(test_iter, PerplexityWithoutExp(ignore_label))
-        for name, val in res:
-            print 'Test-%s=%f' %  (name, val)
+        # the perplexity is computed once, not by the decoding workers (--shard)
+        if args.shard is None:
+            enc_test, dec_test = load_enc_dec_corpus(os.path.join(data_dir, test_file), enc_word2idx, dec_word2idx)
+            sequence_length = np.column_stack([enc_test.lengths, dec_test.lengths + 1])
+            buckets = generate_buckets(sequence_length, num_buckets)
+            test_iter = EncoderDecoderIter(
+                enc_data = enc_test, 
+                dec_data = dec_test, 
+                batch_size = batch_size, 
+                buckets = buckets, 
+                shuffle = False,
+                pad = enc_word2idx.get('<pad>'), 
+                eos = enc_word2idx.get('<eos>'),
+                length_inputs = length_inputs
+            )
+            if num_buckets == 1:
+                mod = mx.mod.Module(*sym_gen(test_iter.default_bucket_key), context = [mx.gpu(0)])
+            else:
+                mod = mx.mod.BucketingModule(
+                    sym_gen = sym_gen, 
+                    default_bucket_key = test_iter.default_bucket_key, 
+                    context = [mx.gpu(0)]
+                )
+            mod.bind(data_shapes=test_iter.provide_data, label_shapes = test_iter.provide_label)
+            mod.set_params(arg_params=arg_params, aux_params=aux_params)
+            res  = mod.score(test_iter, PerplexityWithoutExp(ignore_label))
+            for name, val in res:
+                print 'Test-%s=%f' %  (name, val)
 
         dec_idx2word = {}
         for k, v in dec_word2idx.items():
@@ -327,81 +376,110 @@ if __name__ == '__main__':
         enc_idx2word = {}
         for k, v in enc_word2idx.items():
             enc_idx2word[v] = k
-        g = open(model+'_generate_epoch_%d.txt' % epoch, 'w')
+        # the executors are bound once per encoder length and reused
+        session = InferenceSession(
+            Model, 
+            arg_params, 
+            beam = 20 if task == 'couplet' else 10,
+            enc_input_size = len(enc_word2idx), 
+            dec_input_size = len(dec_word2idx),
+            num_label = len(dec_word2idx),
+            share_embed_weight = share_embed_weight
+        )
+        # the records are streamed as the batches are decoded, eval_and_visual.py --records 
+        # --follow can score them while the generation runs
+        records_path = model+'_generate_epoch_%d.jsonl' % epoch
         
         path = os.path.join(data_dir, test_file)
         with codecs.open(path, 'r', encoding='utf-8', errors='ignore') as f:
             lines = f.readlines()
         dic = defaultdict(str)
+        keys = []
         for line in lines:
             line_list = line.strip().split('\t=>\t')
             if len(line_list) != 2 or len(line_list[0].strip()) != len(line_list[1].strip()) :
                 continue
+            if line_list[0].strip() not in dic:
+                keys.append(line_list[0].strip())
             dic[line_list[0].strip()] += line_list[1].strip() + '\t'
-        index = 0
-        for key in dic:
-            enc_string = key
-            dec_string = dic[key]
-            string_list = enc_string.strip().split()
-            enc_len = len(string_list)
+        dec_unk = dec_word2idx.get('<unk>')
+        posts = []
+        for key in keys:
+            string_list = key.strip().split()
             data = []
             for item in string_list:
                 if enc_word2idx.get(item) is None:
                     data.append(enc_word2idx.get('<unk>'))
                 else:
                     data.append(enc_word2idx.get(item))
-            enc_data = mx.nd.array(np.array(data).reshape(1, enc_len))
-            g.write('post: ' + enc_string.encode('utf8') + '\n')
-            g.write('cmnt: ' + dec_string.encode('utf8') + '\n')
-            g.write('beam search results:\n')
-            seq2seq = Model(
-                enc_input_size = len(enc_word2idx), 
-                dec_input_size = len(dec_word2idx),
-                enc_len = enc_len,
-                dec_len = 1,
-                num_label = len(dec_word2idx),
-                share_embed_weight = share_embed_weight,
-                is_train = False
-            )
-            # ---------------------- print result ------------------
-            if task == 'couplet':
-                results = seq2seq.couplet_predict(enc_data, arg_params)
-                res = []
-                for pair in results:
-                    sent = pair[1]
-                    mystr = ""
-                    for idx in sent:
-                        if dec_idx2word[idx] == '<eos>':
-                            continue
-                        mystr += " " +  dec_idx2word[idx]
-                    res.append((pair[0], mystr.strip()))
-                results = rescore(enc_string, res)
-                minmum = min(10, len(results))
-                for pair in results[0:minmum]:
-                    g.write("score : %f, sentence: %s\n" % (pair[0], pair[1].encode('utf8')))
-                g.write('==============================================\n')
-            else:
-                results = seq2seq.predict(enc_data, arg_params)
-                minmum = min(10, len(results))
-                for pair in results[0:minmum]:
-                    score = pair[0]
-                    sent = pair[1]
-                    mystr = ""
-                    for idx in sent:
-                        if dec_idx2word[idx] == '<eos>':
-                            continue
-                        mystr += " " +  dec_idx2word[idx]
-                    g.write("score : %f, sentence: %s\n" % (score, mystr.encode('utf8')))
-                g.write('==============================================\n')
-            index += 1
-            if index > 500:
+            references = [[dec_word2idx.get(item, dec_unk) for item in ref.split()] 
+                for ref in dic[key].split('\t') if len(ref.strip()) > 0]
+            posts.append((key, references, data))
+            if num_generate is not None and len(posts) >= num_generate:
                 break
-        g.close()
+
+        def decode_posts(shard, path):
+            '''Decode the posts of the indices in shard, their records are streamed to path'''
+            g = open(path, 'w')
+            # ---------------------- batched beam search ------------------
+            # the posts are grouped by length, every group is encoded in one forward 
+            # and all its sentences are decoded together
+            for indices in length_batches([posts[i][2] for i in shard], decode_batch_size):
+                indices = [shard[i] for i in indices]
+                enc_data = mx.nd.array(np.array([posts[i][2] for i in indices]))
+                if task == 'couplet':
+                    constraints = punctuation_constraints(enc_data.asnumpy(), punctuation, len(dec_word2idx))
+                    batch_results = session.batch_couplet_predict(enc_data, constraints = constraints)
+                else:
+                    batch_results = session.batch_predict(enc_data)
+                for i, results in zip(indices, batch_results):
+                    enc_string, references, data = posts[i]
+                    results = [(score, [idx for idx in sent if dec_idx2word[idx] != '<eos>']) for score, sent in results]
+                    if task == 'couplet':
+                        res = [(score, ' '.join([dec_idx2word[idx] for idx in sent]), sent) for score, sent in results]
+                        results = [(line[0], line[2]) for line in rescore(enc_string, res)]
+                    write_record(g, i, data, references, results[0:10])
+            write_end(g, len(shard))
+            g.close()
+
+        def run_workers(num_workers, threads):
+            '''Decode with num_workers processes (this script with --shard), each with threads
+            intra-op threads, the posts are sharded round-robin and their records merged in order
+            '''
+            env = dict(os.environ, OMP_NUM_THREADS = str(threads))
+            processes = []
+            for shard in xrange(num_workers):
+                command = [sys.executable, sys.argv[0], '--mode', mode, '--task', task, '--model', model, 
+                    '--testepoch', str(testepoch), '--workers', str(num_workers), '--shard', str(shard)]
+                processes.append(subprocess.Popen(command, env = env))
+            for process in processes:
+                if process.wait() != 0:
+                    raise RuntimeError('decoding worker failed with code %d' % process.returncode)
+            shard_paths = ['%s.%d' % (records_path, shard) for shard in xrange(num_workers)]
+            merge_records(shard_paths, records_path)
+            for shard_path in shard_paths:
+                os.remove(shard_path)
+
+        # ---------------------- parallel decoding ------------------
+        if args.shard is not None:
+            # a worker: the posts shard, shard + workers, ...
+            decode_posts(range(len(posts))[args.shard::args.workers], '%s.%d' % (records_path, args.shard))
+            sys.exit(0)
+        if args.scaling:
+            print '%-8s %8s %10s %10s' % ('workers', 'threads', 'seconds', 'posts/s')
+            for num_workers in xrange(1, args.workers + 1):
+                threads = args.threads or max(1, multiprocessing.cpu_count() // num_workers)
+                start = time.time()
+                run_workers(num_workers, threads)
+                elapsed = time.time() - start
+                print '%-8d %8d %10.2f %10.2f' % (num_workers, threads, elapsed, len(posts) / elapsed)
+        elif args.workers > 1:
+            start = time.time()
+            run_workers(args.workers, args.threads or max(1, multiprocessing.cpu_count() // args.workers))
+            print 'Decoded %d posts with %d workers in %.2fs' % (len(posts), args.workers, time.time() - start)
+        else:
+            decode_posts(range(len(posts)), records_path)
         
-        list_of_hypothesis, list_of_references = read_file(model+'_generate_epoch_%d.txt' % epoch)
         '''Use blue0 since there are some  sentences with only one word and the lexicon is built on top of one-word segmentation'''
-        blue = corpus_bleu(list_of_references, list_of_hypothesis, 
-            weights=(1,),
-            smoothing_function=None
-        )
+        blue, count = records_bleu(records_path, weights = (1,))
         print 'Test-Blue: %f' % blue